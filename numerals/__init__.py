@@ -1,13 +1,19 @@
 from clld.interfaces import IMapMarker, ICtxFactoryQuery
+from clld.db.meta import DBSession
 from clld.db.models import common
 from clldutils import svg
 from clld.web.app import menu_item, CtxFactoryQuery
 from clld.web.icon import MapMarker
 from pyramid.config import Configurator
-from sqlalchemy.orm import joinedload
+from pyramid.settings import asbool
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, selectinload
 
 # we must make sure custom models are known at database initialization!
 from numerals import models
+from numerals.cache import LRUCache, SqliteStore
+from numerals.interfaces import ICache
+from numerals.lookups import get_lookups
 
 
 class NumeralsFactoryQuery(CtxFactoryQuery):
@@ -23,17 +29,78 @@ class NumeralsFactoryQuery(CtxFactoryQuery):
                     common.Contribution.data
                 )
             )
+        if model == common.Language:
+            return query.options(
+                selectinload(
+                    common.Language.valuesets
+                ).joinedload(
+                    common.ValueSet.contribution
+                ),
+                selectinload(
+                    common.Language.languageidentifier
+                ).joinedload(
+                    common.LanguageIdentifier.identifier
+                ),
+                joinedload(
+                    models.Variety.family
+                ),
+            )
+        if model == common.ValueSet:
+            return query.options(
+                joinedload(
+                    common.ValueSet.values
+                ).joinedload(
+                    common.Value.domainelement
+                ),
+                joinedload(
+                    common.ValueSet.parameter
+                ),
+                joinedload(
+                    common.ValueSet.language
+                ),
+                joinedload(
+                    common.ValueSet.contribution
+                ),
+                selectinload(
+                    common.ValueSet.references
+                ).joinedload(
+                    common.ValueSetReference.source
+                ),
+                selectinload(
+                    common.ValueSet.data
+                ),
+            )
         return query
 
 
 class NumeralsMapMarker(MapMarker):
+    """
+    Icons are cached by (shape, color), since there are only a few dozen distinct ones.
+    """
+    def __init__(self, maxsize=512):
+        self.icons = LRUCache(maxsize=maxsize)
+
     def __call__(self, ctx, req):
-        color = models.get_color(ctx)
+        return self.color_icon(models.get_color(ctx, get_lookups(req).colors), req)
 
+    def color_icon(self, color, req):
         if not color:
-            return MapMarker.__call__(self, ctx, req)
+            return MapMarker.__call__(self, None, req)
+
+        return self.icon('c', color)
+
+    def icon(self, shape, color):
+        return self.icons.get_or_create(
+            (shape, color), lambda: svg.data_url(svg.icon(shape + color)))
 
-        return svg.data_url(svg.icon('c' + color))
+    def warm(self):
+        """
+        Render the icons for the colors of all languages and domain elements.
+        """
+        for model in [common.Language, common.DomainElement]:
+            for jsondata, in DBSession.query(model.jsondata):
+                if (jsondata or {}).get('color'):
+                    self.icon('c', jsondata['color'])
 
 
 _ = lambda s: s
@@ -55,6 +122,44 @@ def main(global_config, **settings):
     config.include('clldmpg')
     config.include('clld_phylogeny_plugin')
     config.include('clld_cognacy_plugin')
-    config.registry.registerUtility(NumeralsMapMarker(), IMapMarker)
+    marker = NumeralsMapMarker(maxsize=int(settings.get('numerals.icon_cache_size', 512)))
+    config.registry.registerUtility(marker, IMapMarker)
     config.registry.registerUtility(NumeralsFactoryQuery(), ICtxFactoryQuery)
+    config.add_tween('numerals.prerendered.geojson_tween_factory')
+    config.add_tween('numerals.httpcache.page_cache_tween_factory')
+    config.registry.registerUtility(
+        LRUCache(
+            maxsize=int(settings.get('numerals.tree_cache_size', 256)),
+            store=SqliteStore(settings['numerals.tree_cache'])
+            if settings.get('numerals.tree_cache') else None),
+        ICache,
+        name='trees')
+    config.registry.registerUtility(
+        LRUCache(maxsize=int(settings.get('numerals.datatable_cache_size', 4096))),
+        ICache,
+        name='datatables')
+    config.registry.registerUtility(
+        LRUCache(maxsize=int(settings.get('numerals.fragment_cache_size', 2048))),
+        ICache,
+        name='fragments')
+    config.registry.registerUtility(
+        LRUCache(
+            maxsize=int(settings.get('numerals.page_cache_size', 1024)),
+            store=SqliteStore(settings['numerals.page_cache_store'])
+            if settings.get('numerals.page_cache_store') else None),
+        ICache,
+        name='pages')
+    # Fill caches before the app is forked into worker processes - unless the app is
+    # bootstrapped by `clld initdb` for a database which doesn't exist yet.
+    try:
+        marker.warm()
+        if asbool(settings.get('numerals.preload_lookups', False)):
+            get_lookups()
+    except SQLAlchemyError:  # pragma: no cover
+        pass
+    finally:
+        DBSession.remove()
+        # Close the connections opened for warming, so they are neither inherited by forked
+        # workers nor keep `clld initdb` from dropping the database.
+        DBSession.get_bind().dispose()
     return config.make_wsgi_app()
@@ -1,66 +1,101 @@
+import json
+
 import ete3
 from clld import interfaces
-from clld.web.adapters.geojson import GeoJsonLanguages
+from clld.web.adapters.geojson import GeoJsonLanguages, get_feature, get_lonlat
 from clld.web.util.htmllib import HTML
 from clld.web.util.helpers import link
 from clld_phylogeny_plugin.interfaces import ITree
 from clld_phylogeny_plugin.tree import Tree
 from clldutils.misc import lazyproperty
 from ete3.coretype.tree import TreeError
+from pyramid.response import Response
+from pyramid.settings import asbool
+from sqlalchemy import and_, select
 from sqlalchemy.orm import joinedload
-from numerals.models import Variety, get_color
-from clld.db.models.common import (
-    Parameter, ValueSet, Language, LanguageIdentifier, Identifier, IdentifierType)
+from numerals.cache import get_cache
+from numerals.lookups import get_lookups, parameter_values
+from numerals.models import Variety
+from numerals.util import data_version
+from clld.db.models.common import Parameter, Language
 from clld.db.meta import DBSession
-from collections import defaultdict
+
+
+def tree_cache_key(phylogeny_id, parameter_ids, version):
+    return '{0}|{1}|{2}'.format(phylogeny_id, ','.join(sorted(parameter_ids)), version)
+
+
+def prune_newick(newick, names):
+    """
+    Prune a tree to the leaves with the given names, keeping the nodes where their lineages split.
+    """
+    t = ete3.Tree(newick, format=9)
+    try:
+        t_dict = dict([n.name, n] for n in t.traverse())
+        to_keep = set(t_dict[name] for name in names if name in t_dict)
+        _, node2path = t.get_common_ancestor(to_keep, get_path=True)
+        to_keep.add(t)
+        n2count = {}
+        visitors2nodes = {}
+        for seed, path in node2path.items():
+            for visited_node in path:
+                if visited_node is not seed:
+                    n2count.setdefault(visited_node, set()).add(seed)
+        for node, visitors in n2count.items():
+            if len(visitors) > 1:
+                visitor_key = frozenset(visitors)
+                visitors2nodes.setdefault(visitor_key, set()).add(node)
+        for visitors, nodes in visitors2nodes.items():
+            if not (to_keep & nodes):
+                to_keep.add(list(nodes)[0])
+        for n in t.get_descendants('postorder'):
+            if n not in to_keep:
+                n.delete(prevent_nondicotomic=False)
+    except TreeError:
+        return ''
+
+    return t.write(format=9)
 
 
 class NumeralbankTree(Tree):
 
-    @lazyproperty
+    @property
     def glottolog2language_ids(self):
-        gl2langids = defaultdict(list)
-        for p in DBSession.query(Identifier.name, LanguageIdentifier.language_pk)\
-                .join(Identifier)\
-                .filter(Identifier.type == IdentifierType.glottolog.value):
-            gl2langids[p[0]].append(p[1])
-        return gl2langids
+        return get_lookups(self.req).glottocode_languages
 
-    @lazyproperty
+    @property
     def langpk2language(self):
-        return dict(p for p in DBSession.query(Language.pk, Language))
+        return get_lookups(self.req).languages
+
+    @lazyproperty
+    def parameters(self):
+        # Values are fetched by `parameter_values`, so we only need the domains here.
+        pids = []
+        if 'parameter' in self.req.params:
+            pids = self.req.params.getall('parameter')
+        elif 'parameters' in self.req.params:
+            pids = self.req.params['parameters'].split(',')
+        if pids:
+            return DBSession.query(Parameter)\
+                .filter(Parameter.id.in_(pids))\
+                .options(joinedload(Parameter.domain))\
+                .all()
+        return []
+
+    @lazyproperty
+    def parameter_values(self):
+        return parameter_values(
+            [p.pk for p in self.parameters], get_lookups(self.req).colors)
+
+    @lazyproperty
+    def selected_labels(self):
+        return get_lookups(self.req).labels(self.ctx.pk, [p.pk for p in self.parameters])
 
     @lazyproperty
     def pruned_newick(self):
-        t = ete3.Tree(self.ctx.newick, format=9)
-        try:
-            t_dict = dict([n.name, n] for n in t.traverse())
-            to_keep = set(
-                t_dict[lg.name] for lg in self.ctx.treelabels
-                if lg.name in t_dict and any(
-                    lang.pk in self.language2valueset for lang in lg.languages))
-            _, node2path = t.get_common_ancestor(to_keep, get_path=True)
-            to_keep.add(t)
-            n2count = {}
-            visitors2nodes = {}
-            for seed, path in node2path.items():
-                for visited_node in path:
-                    if visited_node is not seed:
-                        n2count.setdefault(visited_node, set()).add(seed)
-            for node, visitors in n2count.items():
-                if len(visitors) > 1:
-                    visitor_key = frozenset(visitors)
-                    visitors2nodes.setdefault(visitor_key, set()).add(node)
-            for visitors, nodes in visitors2nodes.items():
-                if not (to_keep & nodes):
-                    to_keep.add(list(nodes)[0])
-            for n in t.get_descendants('postorder'):
-                if n not in to_keep:
-                    n.delete(prevent_nondicotomic=False)
-        except TreeError:
-            return ''
-
-        return t.write(format=9)
+        key = tree_cache_key(self.ctx.id, [p.id for p in self.parameters], data_version(self.req))
+        return get_cache(self.req, 'trees').get_or_create(
+            key, lambda: prune_newick(self.ctx.newick, self.selected_labels))
 
     def comp(self, a, b, has_domain):
         if has_domain:
@@ -101,14 +136,11 @@ class NumeralbankTree(Tree):
             domain = self.domains[pindex]
             values = []
             color = '#ff6600'
-            for lpk in self.glottolog2language_ids[label.name]:
-                try:
-                    vs = self.language2valueset[lpk][pindex]
-                    values.extend(vs.values)
-                    color = get_color(vs)
-                    tip_title.add(self.langpk2language[lpk].name)
-                except (KeyError, AttributeError):
-                    continue
+            for lpk in self.glottolog2language_ids.get(label.name, ()):
+                if lpk in self.parameter_values[parameter.pk]:
+                    color, vals = self.parameter_values[parameter.pk][lpk]
+                    values.extend(vals)
+                    tip_title.add(vals[0].language.name)
             if not values:
                 res['tooltip_title'] = 'Missing data'
                 res['tooltip'] = None
@@ -122,7 +154,7 @@ class NumeralbankTree(Tree):
                 for v in values:
                     lis.append(HTML.li(
                         vname(v) + ': ',
-                        self._lg_link(self.req, v.valueset.language)))
+                        self._lg_link(self.req, v.language)))
                     vls.add(vname(v))
                 res['tip_values'] = ", ".join(sorted(vls))
                 res['tooltip'] = HTML.ul(*lis, class_='unstyled')
@@ -132,7 +164,7 @@ class NumeralbankTree(Tree):
 
         else:
             lis = []
-            for lpk in self.glottolog2language_ids[label.name]:
+            for lpk in self.glottolog2language_ids.get(label.name, ()):
                 lis.append(HTML.li(self._lg_link(self.req, self.langpk2language[lpk])))
                 tip_title.add(self.langpk2language[lpk].name)
             res['tooltip'] = HTML.ul(*lis)
@@ -149,24 +181,79 @@ class NumeralbankTree(Tree):
     @lazyproperty
     def labelSpec(self):
         if self.parameters:
-            r_ = {
+            return {
                 lg.name: [self.get_label_properties(lg, i)
                           for i in range(len(self.parameters))]
-                for lg in self.ctx.treelabels
-                if any(lang.pk in self.language2valueset for lang in lg.languages)}
-            r = {}
-            for k, v in r_.items():
-                r[k] = v
-            return r
+                for lg in self.ctx.treelabels if lg.name in self.selected_labels}
         return {
             lg.name: [self.get_label_properties(lg)]
-            for lg in self.ctx.treelabels if lg.languages}
+            for lg in self.ctx.treelabels if lg.name in self.selected_labels}
 
 
 class NumeralGeoJsonLanguages(GeoJsonLanguages):
+    chunksize = 1000
+
     def feature_iterator(self, ctx, req):
         return ctx.get_query(limit=10000)
 
+    def render_to_response(self, ctx, req):
+        # Filtered requests from the datatable still go through the ORM query.
+        if not asbool(req.registry.settings.get('numerals.stream_geojson', False)) \
+                or any(k.startswith('sSearch_') for k in req.params):
+            return GeoJsonLanguages.render_to_response(self, ctx, req)
+        res = Response(app_iter=self.iter_geojson(ctx, req))
+        res.vary = 'Accept'
+        res.content_type = self.send_mimetype
+        return res
+
+    def iter_geojson(self, ctx, req):
+        """
+        Serialize all languages with coordinates, reading only the columns needed for the map.
+
+        The query runs on a connection of its own, which is released once the response has
+        been sent - i.e. when the WSGI server closes the iterator.
+        """
+        marker = req.registry.getUtility(interfaces.IMapMarker)
+        icons = {}
+        q = select([
+            Language.pk,
+            Language.id,
+            Language.name,
+            Language.latitude,
+            Language.longitude,
+            Language.jsondata,
+        ]).where(and_(
+            Language.active == True,  # noqa: E712
+            Language.latitude != None,  # noqa: E711
+            Language.longitude != None,  # noqa: E711
+        )).order_by(Language.pk)
+
+        yield '{{"type": "FeatureCollection", "properties": {0}, "features": ['.format(
+            json.dumps(self._featurecollection_properties(ctx, req))).encode('utf8')
+        sep = ''
+        with DBSession.get_bind().connect() as conn:
+            rows = conn.execution_options(stream_results=True).execute(q)
+            while True:
+                chunk = rows.fetchmany(self.chunksize)
+                if not chunk:
+                    break
+                features = []
+                for pk, id_, name, lat, lon, jsondata in chunk:
+                    color = (jsondata or {}).get('color')
+                    if color not in icons:
+                        icons[color] = marker.color_icon(color, req)
+                    feature = get_feature(
+                        None,
+                        lonlat=get_lonlat((lon, lat)),
+                        icon=icons[color],
+                        language=dict(pk=pk, id=id_, name=name, latitude=lat, longitude=lon),
+                        name=name)
+                    feature['id'] = id_
+                    features.append(json.dumps(feature))
+                yield (sep + ', '.join(features)).encode('utf8')
+                sep = ', '
+        yield b']}'
+
 
 def includeme(config):
     config.registry.registerUtility(NumeralbankTree, ITree)
@@ -0,0 +1,117 @@
+"""
+Process-wide caches for data which only changes when initializedb/prime_cache run.
+
+Cache keys should include the data version (see `numerals.util.data_version`), so that
+cached items become unreachable once the database is reloaded.
+"""
+import sqlite3
+import threading
+import collections
+
+from zope.interface import implementer
+
+from numerals.interfaces import ICache
+
+
+class SqliteStore(object):
+    """
+    A persistent key-value store in an SQLite file, which can be shared between processes.
+    """
+    def __init__(self, path, table='cache'):
+        self.path = str(path)
+        self.table = table
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value)'.format(table))
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key, default=None):
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT value FROM {0} WHERE key = ?'.format(self.table), (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key, value):
+        self.update([(key, value)])
+
+    def update(self, items):
+        with self._connect() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO {0} (key, value) VALUES (?, ?)'.format(self.table),
+                items)
+
+    def clear(self):
+        with self._connect() as db:
+            db.execute('DELETE FROM {0}'.format(self.table))
+
+
+@implementer(ICache)
+class LRUCache(object):
+    """
+    A thread-safe in-memory cache of bounded size, evicting the least recently used items.
+
+    If a `store` is given, it is consulted on misses and written through on updates.
+    """
+    def __init__(self, maxsize=1024, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+
+    def _set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is None and self.store is not None:
+            value = self.store.get(key)
+            if value is not None:
+                self._set(key, value)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self._set(key, value)
+        if self.store is not None:
+            self.store.set(key, value)
+
+    def get_or_create(self, key, creator):
+        value = self.get(key)
+        if value is None:
+            value = creator()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        return dict(size=len(self), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+
+def get_cache(req, name):
+    return req.registry.getUtility(ICache, name=name)
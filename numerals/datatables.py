@@ -1,9 +1,14 @@
+import re
+
 from clld.db.models.common import (
     Language, Parameter, DomainElement, Value, Contribution,
-    ValueSet, Identifier, LanguageIdentifier, IdentifierType, Source
+    ValueSet, LanguageIdentifier, Source
 )
 from clld.db.util import icontains
-from clld.web.datatables.base import LinkCol, DetailsRowLinkCol, LinkToMapCol, Col
+from clld.db.meta import DBSession
+from clld.web.datatables.base import (
+    LinkCol, DetailsRowLinkCol, LinkToMapCol, Col, DISPLAY_LIMIT, type_coerce,
+)
 from clld.web.datatables.language import Languages
 from clld.web.datatables.parameter import Parameters
 from clld.web.datatables.source import Sources, TypeCol
@@ -16,12 +21,14 @@ from clld_glottologfamily_plugin.datatables import FamilyCol
 from clld_glottologfamily_plugin.models import Family
 from clld_cognacy_plugin.datatables import ConcepticonCol
 from clld_cognacy_plugin.util import concepticon_link
-from sqlalchemy import BigInteger, and_, func
-from sqlalchemy.sql.expression import cast
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, or_
+from pyramid.settings import asbool
+from sqlalchemy.orm import Query, joinedload
 
 from numerals.models import Variety, NumberLexeme, NumberParameter, Provider
-from numerals.util import get_contributions
+from numerals.cache import get_cache
+from numerals.util import get_contributions, data_version, normalize_form
+from numerals.search import search
 
 
 class BoolCol(Col):
@@ -32,6 +39,11 @@ class BoolCol(Col):
         return ''
 
 
+class SearchCol(Col):
+    def search(self, qs):
+        return search(self.model_col, qs)
+
+
 class NumeralGlottocodeCol(Col):
     __kw__ = {"bSortable": False}
 
@@ -45,10 +57,6 @@ class NumeralGlottocodeCol(Col):
         else:
             return ""
 
-    def search(self, qs):
-        return and_(Identifier.type.__eq__(IdentifierType.glottolog.value),
-                    icontains(Identifier.name, qs))
-
 
 class NumeralISOCol(Col):
     __kw__ = {"bSortable": False}
@@ -56,14 +64,10 @@ class NumeralISOCol(Col):
     def format(self, item):
         return item.iso_code
 
-    def search(self, qs):
-        return and_(Identifier.type.__eq__(IdentifierType.iso.value),
-                    icontains(Identifier.name, qs))
-
 
 class NumeralValueNameCol(ValueNameCol):
     def order(self):
-        return func.translate(Value.name, 'ˈ,ː,ˌ', '')
+        return NumberLexeme.normalized_form
 
     def format(self, item):
         if item.domainelement:
@@ -77,24 +81,40 @@ class NumeralValueNameCol(ValueNameCol):
     def search(self, qs):
         if self.dt.parameter and self.dt.parameter.name == 'Base':
             return icontains(DomainElement.name, qs)
-        else:
-            return icontains(Value.name, qs)
+        form = normalize_form(qs)
+        if form.strip('^$'):
+            return search(NumberLexeme.normalized_form, form)
+        return search(Value.name, qs)
 
 
-class NumeralParameterCol(LinkCol):
-    @staticmethod
-    def get_attrs(item):
-        return {"label": item}
+# Searches like "1-20", "100-" or "-10" select numerals by range:
+NUMBER_RANGE = re.compile(r'^\s*(?P<lower>\d+)?\s*[-–]\s*(?P<upper>\d+)?\s*$')
 
+
+class NumberCol(LinkCol):
     @staticmethod
     def order():
-        return cast(Parameter.id, BigInteger)
+        return NumberParameter.number
 
+    def search(self, qs):
+        match = NUMBER_RANGE.match(qs)
+        if match and any(match.groups()):
+            # The lower bound also excludes the "Base" parameter, which has number -1.
+            clauses = [NumberParameter.number >= int(match.group('lower') or 0)]
+            if match.group('upper'):
+                clauses.append(NumberParameter.number <= int(match.group('upper')))
+            return and_(*clauses)
+        return super(NumberCol, self).search(qs)
 
-class NumeralValueCol(LinkCol):
+
+class NumeralParameterCol(NumberCol):
     @staticmethod
-    def order():
-        return cast(Parameter.id, BigInteger)
+    def get_attrs(item):
+        return {"label": item}
+
+
+class NumeralValueCol(NumberCol):
+    pass
 
 
 class NumberConcepticonCol(ConcepticonCol):
@@ -152,7 +172,7 @@ class NumeralSources(Sources):
                 self,
                 'contribution',
                 model_col=Contribution.id,
-                choices=get_contributions(),
+                choices=get_contributions(req=self.req),
                 get_object=lambda i: i.provider,
             ),
         ]
@@ -190,8 +210,7 @@ class NumeralContributions(Contributions):
 
 class Varieties(Languages):
     def base_query(self, query):
-        return query.distinct().join(Variety.family, isouter=True)\
-            .join(*Variety.identifiers.attr, isouter=True)
+        return query.join(Variety.family, isouter=True)
 
     def col_defs(self):
         return [
@@ -205,11 +224,13 @@ class Varieties(Languages):
             ),
             NumeralGlottocodeCol(
                 self,
-                'Glottocode'
+                'Glottocode',
+                model_col=Variety.glottocode,
             ),
             NumeralISOCol(
                 self,
                 'ISO',
+                model_col=Variety.iso_code,
                 sTitle='ISO 639-3'
             ),
             Col(
@@ -231,7 +252,7 @@ class Varieties(Languages):
                 self,
                 "contribution",
                 model_col=Variety.contrib_name,
-                choices=get_contributions(),
+                choices=get_contributions(req=self.req),
             ),
         ]
 
@@ -274,23 +295,125 @@ class Numerals(Parameters):
         ]
 
 
+class CachedCountQuery(Query):
+    """
+    A query caching its counts per data version and SQL statement.
+    """
+    @classmethod
+    def from_query(cls, query, cache, version):
+        res = cls.__new__(cls)
+        res.__dict__ = dict(query.__dict__, _count_cache=(cache, version))
+        return res
+
+    def count(self):
+        cache, version = self._count_cache
+        sql = self.statement.compile(dialect=self.session.get_bind().dialect)
+        return cache.get_or_create(
+            repr((version, str(sql), sorted(sql.params.items()))), lambda: Query.count(self))
+
+
 class Datapoints(Values):
     def base_query(self, query):
+        # An explicit left side for the joins, which stay unambiguous when `get_query` adds
+        # the sort keys as columns. (The query is passed in filtered by `Value.active` already.)
+        query = query.enable_assertions(False).select_from(Value).enable_assertions(True)
         query = Values.base_query(self, query)
         if self.parameter:
-            return query.join(Family, isouter=True).options(
+            query = query.join(Family, isouter=True).options(
                 joinedload(Value.valueset).joinedload(ValueSet.language),
             )
         elif self.contribution:
-            return query.join(Language, isouter=True).options(
+            query = query.join(Language, isouter=True).options(
                 joinedload(Value.valueset).joinedload(ValueSet.parameter),
                 joinedload(Value.valueset).joinedload(ValueSet.language),
                 joinedload(Value.valueset).joinedload(ValueSet.contribution),
                 joinedload(Value.domainelement),
             )
-        else:
+        elif not self.language:
+            # The parameter and language columns search and sort on the joined tables:
+            query = query.join(ValueSet.parameter).join(ValueSet.language).options(
+                joinedload(Value.valueset).joinedload(ValueSet.parameter),
+                joinedload(Value.valueset).joinedload(ValueSet.language),
+            )
+        if self.keyset_pagination:
+            query = CachedCountQuery.from_query(
+                query, get_cache(self.req, 'datatables'), data_version(self.req))
+        return query
+
+    @property
+    def keyset_pagination(self):
+        return asbool(self.req.registry.settings.get('numerals.keyset_pagination', False))
+
+    def sort_keys(self):
+        """
+        The expressions the query is ordered by, as pairs (SQL expression, descending?) - as
+        added by `DataTable.get_query`.
+        """
+        keys = []
+        for index in range(min(type_coerce(int, self.req.params.get('iSortingCols', 0), 0), 10)):
+            try:
+                col = self.cols[int(self.req.params.get('iSortCol_%s' % index))]
+            except (TypeError, ValueError, IndexError):  # pragma: no cover
+                continue
+            if col.js_args.get('bSortable', True):
+                orders = col.order()
+                if orders is not None:
+                    desc = self.req.params.get('sSortDir_%s' % index) == 'desc'
+                    keys.extend(
+                        (order, desc)
+                        for order in (orders if isinstance(orders, (tuple, list)) else [orders]))
+        return keys + [(self.default_order(), False)]
+
+    @staticmethod
+    def following(keys, bookmark):
+        """
+        Condition selecting the rows ordered after a row with the sort keys `bookmark`.
+        """
+        # NULLs sort after all values on PostgreSQL, before all values on SQLite:
+        nulls_high = DBSession.get_bind().dialect.name == 'postgresql'
+        clauses, equal = [], []
+        for (expr, desc), value in zip(keys, bookmark):
+            nulls_last = nulls_high != desc
+            if value is None:
+                later = None if nulls_last else expr.isnot(None)
+                same = expr.is_(None)
+            else:
+                later = expr < value if desc else expr > value
+                if nulls_last:
+                    later = or_(later, expr.is_(None))
+                same = expr == value
+            if later is not None:
+                clauses.append(and_(*equal, later))
+            equal.append(same)
+        return or_(*clauses)
+
+    def get_query(self, limit=DISPLAY_LIMIT, offset=0, undefer_cols=()):
+        """
+        With `numerals.keyset_pagination` set, counts are cached (see `base_query`), and a page
+        following a page served before is selected by the sort keys of the last row of that
+        page rather than by OFFSET.
+        """
+        query = Values.get_query(self, limit=limit, offset=offset, undefer_cols=undefer_cols)
+        if not self.keyset_pagination:
             return query
 
+        cache = get_cache(self.req, 'datatables')
+        # The rows up to a position only depend on scope, filters and sorting:
+        key = [data_version(self.req), type(self).__name__] + sorted(
+            (k, v) for k, v in self.req.params.items()
+            if k not in {'iDisplayStart', 'iDisplayLength', 'sEcho', '_'})
+        start = type_coerce(int, self.req.params.get('iDisplayStart', offset), offset)
+        keys = self.sort_keys()
+        bookmark = cache.get(repr(key + [start])) if start else None
+        if bookmark is not None:
+            # Replace the OFFSET, keeping the LIMIT:
+            query = query.enable_assertions(False).offset(None)\
+                .filter(self.following(keys, bookmark))
+        rows = query.add_columns(*[expr for expr, _ in keys]).all()
+        if rows:
+            cache.set(repr(key + [start + len(rows)]), tuple(rows[-1][1:]))
+        return [row[0] for row in rows]
+
     def get_options(self):
         opts = super(Values, self).get_options()
         if self.parameter:
@@ -326,13 +449,13 @@ class Datapoints(Values):
                     "form",
                     model_col=Value.name,
                 ),
-                Col(
+                SearchCol(
                     self,
                     "other_form",
                     sTitle="Original Form",
                     model_col=NumberLexeme.other_form,
                 ),
-                Col(
+                SearchCol(
                     self,
                     "comment",
                     model_col=NumberLexeme.comment,
@@ -347,7 +470,7 @@ class Datapoints(Values):
                     self,
                     "contribution",
                     model_col=Variety.contrib_name,
-                    choices=get_contributions(),
+                    choices=get_contributions(req=self.req),
                     get_object=lambda i: i.valueset.language
                 ),
             ]
@@ -364,13 +487,13 @@ class Datapoints(Values):
                     "form",
                     model_col=Value.name
                 ),
-                Col(
+                SearchCol(
                     self,
                     "other_form",
                     sTitle="Original Form",
                     model_col=NumberLexeme.other_form,
                 ),
-                Col(
+                SearchCol(
                     self,
                     "comment",
                     model_col=NumberLexeme.comment,
@@ -401,13 +524,13 @@ class Datapoints(Values):
                     "form",
                     model_col=Value.name
                 ),
-                Col(
+                SearchCol(
                     self,
                     "other_form",
                     sTitle="Original Form",
                     model_col=NumberLexeme.other_form,
                 ),
-                Col(
+                SearchCol(
                     self,
                     "comment",
                     model_col=NumberLexeme.comment,
@@ -0,0 +1,115 @@
+"""
+Caching of rendered pages.
+
+Since the data only changes when initializedb/prime_cache run, a page is determined by the
+data version (see `numerals.util.data_version`) and the request. With `numerals.page_cache`
+set, `page_cache_tween_factory` stores rendered responses in the 'pages' cache and serves
+them with ETags computed from the data version and the request. Thus, conditional requests
+are answered with 304 without rendering anything and - except for periodic checks of the
+data version - without database access.
+"""
+import json
+import time
+import hashlib
+import threading
+
+from clld.db.meta import DBSession
+from clld.db.models.common import Dataset
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+from numerals.interfaces import ICache
+from numerals.snapshot import SNAPSHOT
+
+# Headers which are not stored with a cached page, because they are recomputed:
+SKIP_HEADERS = {'content-length', 'date', 'etag', 'cache-control', 'set-cookie'}
+
+
+class PageCache(object):
+    def __init__(self, cache, max_age=600, version_ttl=60):
+        self.cache = cache
+        self.max_age = max_age
+        # The data version is re-read from the database at most every `version_ttl` seconds:
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_read = 0
+        self._lock = threading.Lock()
+
+    def data_version(self):
+        with self._lock:
+            if self._version is None or time.time() - self._version_read > self.version_ttl:
+                jsondata = DBSession.query(Dataset.jsondata).scalar() or {}
+                self._version = jsondata.get('data_version', '')
+                self._version_read = time.time()
+            return self._version
+
+    @staticmethod
+    def cacheable(req):
+        # Pages rendered for the static mirror link to its files - they must not be served
+        # by the app.
+        return req.method in ('GET', 'HEAD') and not req.is_xhr \
+            and 'Authorization' not in req.headers and not req.environ.get(SNAPSHOT)
+
+    @staticmethod
+    def key(req):
+        # Pages contain absolute URLs, thus depend on scheme and host, too:
+        return '{0} {1} {2}'.format(req.host_url, req.path_qs, req.headers.get('Accept', ''))
+
+    @staticmethod
+    def etag(version, key):
+        return hashlib.md5('{0} {1}'.format(version, key).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def dumps(res):
+        headers = [(k, v) for k, v in res.headerlist if k.lower() not in SKIP_HEADERS]
+        return json.dumps([res.status, headers]).encode('utf8') + b'\n' + res.body
+
+    @staticmethod
+    def loads(data):
+        head, _, body = data.partition(b'\n')
+        status, headers = json.loads(head.decode('utf8'))
+        return Response(status=status, headerlist=[tuple(h) for h in headers], body=body)
+
+    def finish(self, res, etag):
+        res.etag = etag
+        res.cache_control = 'public, max-age={0}'.format(self.max_age)
+        vary = tuple(res.vary or ())
+        res.vary = vary if 'Accept' in vary else vary + ('Accept',)
+        return res
+
+    def __call__(self, req, handler):
+        if not self.cacheable(req):
+            return handler(req)
+
+        version, key = self.data_version(), self.key(req)
+        etag = self.etag(version, key)
+        if etag in req.if_none_match:
+            return self.finish(Response(status=304), etag)
+
+        data = self.cache.get(repr((version, key)))
+        if data is not None:
+            return self.finish(self.loads(data), etag)
+
+        res = handler(req)
+        # Only complete, successful responses are stored - not streamed ones, and not encoded
+        # ones like the pre-rendered GeoJSON files, which depend on Accept-Encoding.
+        if res.status_int != 200 or res.content_length is None or res.content_encoding \
+                or req.method != 'GET':
+            return res
+        self.cache.set(repr((version, key)), self.dumps(res))
+        return self.finish(res, etag)
+
+
+def page_cache_tween_factory(handler, registry):
+    settings = registry.settings
+    if not asbool(settings.get('numerals.page_cache', False)):
+        return handler
+    pages = PageCache(
+        registry.getUtility(ICache, name='pages'),
+        max_age=int(settings.get('numerals.page_cache_max_age', 600)),
+        version_ttl=int(settings.get('numerals.page_cache_version_ttl', 60)))
+
+    def page_cache_tween(req):
+        return pages(req, handler)
+
+    return page_cache_tween
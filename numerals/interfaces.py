@@ -0,0 +1,5 @@
+from zope.interface import Interface
+
+
+class ICache(Interface):
+    """Marker interface for the named, process-wide caches of the app."""
@@ -0,0 +1,144 @@
+"""
+Process-wide, read-only lookup tables built from the database.
+
+The tables are built on first use and rebuilt when the data version changes, i.e. after
+prime_cache ran again.
+"""
+import threading
+import collections
+
+from clld.db.meta import DBSession
+from clld.db.models.common import (
+    Dataset, Language, ValueSet, Value, DomainElement, Identifier, LanguageIdentifier,
+    IdentifierType, Contribution,
+)
+from clld_phylogeny_plugin.models import TreeLabel, LanguageTreeLabel
+
+from numerals.models import Colors, Provider
+from numerals.util import data_version
+
+
+class LanguageRecord(object):
+    """
+    The attributes of a language needed to link to it, without the overhead of an ORM instance.
+    """
+    __slots__ = ('pk', 'id', 'name')
+
+    def __init__(self, pk, id_, name):
+        self.pk = pk
+        self.id = id_
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+ValueRecord = collections.namedtuple('ValueRecord', ['name', 'domainelement_pk', 'language'])
+ProviderRecord = collections.namedtuple('ProviderRecord', ['id', 'name', 'accessURL', 'version'])
+
+
+def parameter_values(parameter_pks, colors):
+    """
+    Fetch the values for the given parameters in one query, as `dict` mapping parameter pk
+    to `dict` mapping language pk to the pair (color of the first value, list of `ValueRecord`).
+    """
+    res = collections.defaultdict(dict)
+    for ppk, lpk, lid, lname, name, de_pk in DBSession.query(
+            ValueSet.parameter_pk, Language.pk, Language.id, Language.name,
+            Value.name, Value.domainelement_pk)\
+            .join(Value.valueset)\
+            .join(ValueSet.language)\
+            .filter(ValueSet.parameter_pk.in_(parameter_pks))\
+            .order_by(Value.pk):
+        if lpk not in res[ppk]:
+            color = colors.domainelement.get(de_pk) if de_pk else colors.language.get(lpk)
+            res[ppk][lpk] = (color, [])
+        res[ppk][lpk][1].append(ValueRecord(name, de_pk, LanguageRecord(lpk, lid, lname)))
+    return res
+
+
+class Lookups(object):
+    """
+    Sets of languages are represented as bitsets, i.e. Python ints with the bits at the positions
+    of the languages' primary keys set.
+    """
+    def __init__(self, version):
+        self.version = version
+
+        self.colors = Colors(
+            language={
+                pk: (jsondata or {}).get('color')
+                for pk, jsondata in DBSession.query(Language.pk, Language.jsondata)},
+            domainelement={
+                pk: (jsondata or {}).get('color')
+                for pk, jsondata in DBSession.query(DomainElement.pk, DomainElement.jsondata)},
+        )
+
+        self.languages = {
+            pk: LanguageRecord(pk, id_, name)
+            for pk, id_, name in DBSession.query(Language.pk, Language.id, Language.name)}
+
+        self.contribution_ids = [
+            id_ for id_, in DBSession.query(Contribution.id).order_by(Contribution.id)]
+        self.providers = [
+            ProviderRecord(*row) for row in DBSession.query(
+                Provider.id, Provider.name, Provider.accessURL, Provider.version)
+            .order_by(Provider.id)]
+
+        # glottocode (or ISO code) -> pks of the languages with this code:
+        code_languages = {
+            IdentifierType.glottolog.value: collections.defaultdict(list),
+            IdentifierType.iso.value: collections.defaultdict(list),
+        }
+        for type_, code, lpk in DBSession.query(
+                Identifier.type, Identifier.name, LanguageIdentifier.language_pk)\
+                .join(LanguageIdentifier.identifier)\
+                .filter(Identifier.type.in_(list(code_languages)))\
+                .order_by(LanguageIdentifier.pk):
+            code_languages[type_][code].append(lpk)
+        self.glottocode_languages, self.iso_languages = [
+            {code: tuple(pks) for code, pks in code_languages[type_.value].items()}
+            for type_ in [IdentifierType.glottolog, IdentifierType.iso]]
+
+        # parameter pk -> languages with a valueset for the parameter:
+        self.parameter_languages = collections.defaultdict(int)
+        for lpk, ppk in DBSession.query(ValueSet.language_pk, ValueSet.parameter_pk).distinct():
+            self.parameter_languages[ppk] |= 1 << lpk
+
+        # phylogeny pk -> tree label name -> languages linked to the label:
+        self.phylogeny_labels = collections.defaultdict(lambda: collections.defaultdict(int))
+        for phylo_pk, name, lpk in DBSession.query(
+                TreeLabel.phylogeny_pk, TreeLabel.name, LanguageTreeLabel.language_pk)\
+                .join(LanguageTreeLabel, LanguageTreeLabel.treelabel_pk == TreeLabel.pk):
+            self.phylogeny_labels[phylo_pk][name] |= 1 << lpk
+
+    def labels(self, phylogeny_pk, parameter_pks=None):
+        """
+        Names of the labels of a phylogeny linked to languages with data for any of the
+        parameters - or to any language at all, if no parameters are given.
+        """
+        labels = self.phylogeny_labels.get(phylogeny_pk, {})
+        if not parameter_pks:
+            return set(labels)
+        mask = 0
+        for ppk in parameter_pks:
+            mask |= self.parameter_languages.get(ppk, 0)
+        return {name for name, languages in labels.items() if languages & mask}
+
+
+_lookups = None
+_lock = threading.Lock()
+
+
+def get_lookups(req=None):
+    """
+    Without a request, e.g. when preloading the lookups at startup, the data version is read
+    from the database.
+    """
+    global _lookups
+    version = data_version(req) if req else \
+        DBSession.query(Dataset).one().jsondata.get('data_version', '')
+    with _lock:
+        if _lookups is None or _lookups.version != version:
+            _lookups = Lookups(version)
+        return _lookups
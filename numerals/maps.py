@@ -1,7 +1,16 @@
 from clld.web.maps import ParameterMap, Map
 
+from numerals.snapshot import SNAPSHOT, layer_path
+
 
 class NumeralParameterMap(ParameterMap):
+    def get_layers(self):
+        for layer in super().get_layers():
+            if self.ctx.domain and self.req.environ.get(SNAPSHOT):
+                # In the static mirror, each layer has a file of its own.
+                layer.data = self.req.application_url + layer_path(self.ctx.id, layer.id)
+            yield layer
+
     def get_options(self):
         return {
             'icon_size': 15,
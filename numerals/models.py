@@ -1,3 +1,5 @@
+import collections
+
 from clld import interfaces
 from clld.db.meta import CustomModelMixin
 from clld.db.models.common import Language, ValueSet, Value, DomainElement, Parameter, Contribution, Source
@@ -5,6 +7,7 @@ from clld_glottologfamily_plugin.models import HasFamilyMixin
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     Boolean,
     ForeignKey,
     Unicode
@@ -13,7 +16,28 @@ from sqlalchemy.orm import relationship, backref
 from zope.interface import implementer
 
 
-def get_color(ctx):
+# Colors of languages and domain elements, as dicts mapping pk to color:
+Colors = collections.namedtuple('Colors', ['language', 'domainelement'])
+
+
+def get_color(ctx, colors=None):
+    """
+    With a `Colors` index, the color is looked up by primary key instead of being read from
+    the JSON data of related objects.
+    """
+    if colors is not None:
+        if isinstance(ctx, ValueSet):
+            de_pk, lpk = ctx.values[0].domainelement_pk, ctx.language_pk
+        elif isinstance(ctx, Value):
+            de_pk, lpk = ctx.domainelement_pk, ctx.valueset.language_pk
+        elif isinstance(ctx, DomainElement):
+            de_pk, lpk = ctx.pk, None
+        elif isinstance(ctx, Language):
+            de_pk, lpk = None, ctx.pk
+        else:
+            return None
+        return colors.domainelement.get(de_pk) if de_pk else colors.language.get(lpk)
+
     color = None
 
     if isinstance(ctx, ValueSet):
@@ -41,6 +65,8 @@ class NumberLexeme(CustomModelMixin, Value):
     is_loan = Column(Boolean, default=False)
     other_form = Column(Unicode)
     org_form = Column(Unicode)
+    # The form as computed by `numerals.util.normalize_form`, for sorting and searching:
+    normalized_form = Column(Unicode, index=True)
     comment = Column(Unicode)
     is_problematic = Column(Boolean, default=False)
 
@@ -52,12 +78,17 @@ class Variety(CustomModelMixin, Language, HasFamilyMixin):
     comment = Column(Unicode)
     url_soure_name = Column(Unicode)
     contrib_name = Column(Unicode)
+    # Denormalized from the identifiers, overriding the properties of `Language`:
+    glottocode = Column(Unicode, index=True)
+    iso_code = Column(Unicode, index=True)
 
 
 @implementer(interfaces.IParameter)
 class NumberParameter(CustomModelMixin, Parameter):
     pk = Column(Integer, ForeignKey('parameter.pk'), primary_key=True)
     concepticon_id = Column(Integer)
+    # The numeric value of the numeral, for sorting and range queries:
+    number = Column(BigInteger, index=True)
     count_of_datapoints = Column(Integer)
     count_of_varieties = Column(Integer)
 
@@ -0,0 +1,133 @@
+"""
+Pre-rendered GeoJSON for the parameter maps.
+
+`render_geojson` writes the GeoJSON of each map layer - i.e. of each parameter or, for
+parameters with a domain, of each domain element - to a gzipped file. With
+`numerals.geojson_dir` set, these files are served by `geojson_tween_factory`.
+"""
+import re
+import gzip
+import hashlib
+import pathlib
+import urllib.parse
+
+from clld.db.meta import DBSession
+from clld.db.models.common import Parameter, DomainElement
+from pyramid.request import Request
+from pyramid.response import Response, FileIter
+
+# Marks requests which must be rendered by the app, e.g. to (re-)create the files:
+BYPASS = 'numerals.prerendered.bypass'
+GEOJSON_PATH = re.compile(r'/parameters/(?P<id>[^/.]+)\.geojson$')
+
+
+def geojson_name(parameter_id, domainelement_id=None):
+    if domainelement_id is None:
+        return '{0}.geojson.gz'.format(parameter_id)
+    return '{0}-{1}.geojson.gz'.format(parameter_id, domainelement_id)
+
+
+def geojson_path(parameter_id, domainelement_id=None):
+    """
+    The path of the GeoJSON request for a map layer, as sent by the parameter maps.
+    """
+    query = dict(layer=domainelement_id or parameter_id)
+    if domainelement_id:
+        query['domainelement'] = domainelement_id
+    return '/parameters/{0}.geojson?{1}'.format(
+        urllib.parse.quote(parameter_id), urllib.parse.urlencode(query))
+
+
+def iter_layers():
+    """
+    The layers of the parameter maps as pairs (parameter ID, domain element ID or None).
+    """
+    q = DBSession.query(Parameter.id, DomainElement.id)\
+        .outerjoin(DomainElement, DomainElement.parameter_pk == Parameter.pk)\
+        .order_by(Parameter.pk, DomainElement.pk)
+    for pid, deid in q:
+        yield pid, deid
+
+
+def render_geojson(app, directory, log=None):
+    """
+    Request the GeoJSON for all map layers from the WSGI app and write it to `directory`.
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for pid, deid in iter_layers():
+        req = Request.blank(geojson_path(pid, deid))
+        req.environ[BYPASS] = True
+        res = req.get_response(app)
+        if res.status_int != 200:  # pragma: no cover
+            if log:
+                log.warning('{0}: {1}'.format(req.path_qs, res.status))
+            continue
+        path = directory / geojson_name(pid, deid)
+        tmp = path.parent / (path.name + '.tmp')
+        # A fixed mtime makes the files - and thus the ETags - reproducible.
+        tmp.write_bytes(gzip.compress(res.body, mtime=0))
+        tmp.replace(path)
+        count += 1
+    if log:
+        log.info('{0} GeoJSON files written to {1}'.format(count, directory))
+    return count
+
+
+class GeoJsonFiles(object):
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self._etags = {}
+
+    def path(self, req):
+        """
+        The file for a GeoJSON request as sent by the parameter maps, or None.
+        """
+        match = GEOJSON_PATH.match(req.path_info)
+        if not match or req.method not in ('GET', 'HEAD') \
+                or set(req.GET) - {'layer', 'domainelement'}:
+            return None
+        pid, deid = match.group('id'), req.GET.get('domainelement')
+        if req.GET.get('layer') != (deid or pid):
+            return None
+        path = self.directory / geojson_name(pid, deid)
+        return path if path.exists() else None
+
+    def etag(self, path):
+        stat = path.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self._etags.get(path.name, (None,))[0] != key:
+            self._etags[path.name] = (key, hashlib.md5(path.read_bytes()).hexdigest())
+        return self._etags[path.name][1]
+
+    def response(self, req, path):
+        if 'gzip' in req.headers.get('Accept-Encoding', ''):
+            res = Response(
+                app_iter=FileIter(path.open('rb')),
+                content_length=path.stat().st_size,
+                content_encoding='gzip')
+            res.etag = self.etag(path) + '-gzip'
+        else:
+            with gzip.open(str(path), 'rb') as fp:
+                res = Response(body=fp.read())
+            res.etag = self.etag(path)
+        res.content_type = 'application/json'
+        res.vary = ('Accept', 'Accept-Encoding')
+        res.conditional_response = True
+        return res
+
+
+def geojson_tween_factory(handler, registry):
+    directory = registry.settings.get('numerals.geojson_dir')
+    if not directory:
+        return handler
+    files = GeoJsonFiles(directory)
+
+    def geojson_tween(req):
+        path = None if req.environ.get(BYPASS) else files.path(req)
+        if path:
+            return files.response(req, path)
+        return handler(req)
+
+    return geojson_tween
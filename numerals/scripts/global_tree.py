@@ -4,20 +4,65 @@ Recreate glottolog data files from the current version published at http://glott
 from __future__ import unicode_literals
 
 import re
+import hashlib
+import sqlite3
+import pathlib
 
+from clldutils.path import git_describe
 from ete3 import Tree
+from ete3.coretype.tree import TreeError
 from pyglottolog.api import Glottolog
 
 
-def tree(glottocodes, gl_repos):
+SNAPSHOT_SCHEMA = """\
+CREATE TABLE languoid (id TEXT PRIMARY KEY, lineage TEXT, category TEXT, level TEXT);
+CREATE TABLE family (id TEXT PRIMARY KEY, ord INTEGER, level TEXT, newick TEXT);
+"""
+
+
+def glottolog_version(gl_repos):
+    """
+    Identify a Glottolog release by the git version of the repository and its `.zenodo.json`.
+    """
+    gl_repos = pathlib.Path(gl_repos)
+    zenodo = gl_repos / '.zenodo.json'
+    if not (gl_repos / '.git').exists() and not zenodo.exists():
+        return None
+    version = hashlib.sha1(git_describe(gl_repos).encode('utf8'))
+    if zenodo.exists():
+        version.update(zenodo.read_bytes())
+    return version.hexdigest()
+
+
+def languoid_snapshot(gl_repos, cache_dir=None):
+    """
+    Return a connection to an SQLite snapshot of the languoid data needed by `tree`.
+
+    The snapshot lists all languoids with their lineage, category and level and the top-level
+    families with their newick representation. If `cache_dir` is given, the snapshot is stored
+    there, keyed by the Glottolog version, so the repository walk is done once per release.
+    """
+    version = glottolog_version(gl_repos) if cache_dir else None
+    if version:
+        path = pathlib.Path(cache_dir) / 'glottolog-{0}.sqlite'.format(version)
+        if path.exists():
+            db = sqlite3.connect(str(path))
+            db.execute('PRAGMA mmap_size = 268435456')
+            return db
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.parent / (path.name + '.tmp')
+        if tmp.exists():
+            tmp.unlink()
+        db = sqlite3.connect(str(tmp))
+    else:
+        db = sqlite3.connect(':memory:')
+
     label_pattern = re.compile(r"'[^\[]+\[([a-z0-9]{4}[0-9]{4})[^']*'")
 
     def rename(n):
         n.name = label_pattern.match(n.name).groups()[0]
         n.length = 1
 
-    glottocodes = set(glottocodes)
-    glottocodes_in_global_tree = set()
     languoids = {}
     families = []
 
@@ -27,22 +72,64 @@ def tree(glottocodes, gl_repos):
                 families.append(lang)
         languoids[lang.id] = lang
 
+    db.executescript(SNAPSHOT_SCHEMA)
+    db.executemany(
+        'INSERT INTO languoid VALUES (?, ?, ?, ?)',
+        [(lang.id, ' '.join(li[1] for li in lang.lineage), lang.category, lang.level.name)
+         for lang in languoids.values()])
+    rows = []
+    for i, family in enumerate(families):
+        node = family.newick_node(nodes=languoids)
+        node.visit(rename)
+        rows.append((family.id, i, family.level.name, node.newick))
+    db.executemany('INSERT INTO family VALUES (?, ?, ?, ?)', rows)
+    db.commit()
+
+    if version:
+        db.close()
+        tmp.rename(path)
+        return languoid_snapshot(gl_repos, cache_dir=cache_dir)
+    return db
+
+
+def tree(glottocodes, gl_repos, cache_dir=None):
+    glottocodes = set(glottocodes)
+    glottocodes_in_global_tree = set()
+
+    db = languoid_snapshot(gl_repos, cache_dir=cache_dir)
+    try:
+        # Only families containing any of the glottocodes need to be considered:
+        family_ids = set()
+        for gc in glottocodes:
+            for lineage, in db.execute('SELECT lineage FROM languoid WHERE id = ?', (gc,)):
+                family_ids.add(lineage.split()[0] if lineage else gc)
+        families = []
+        family_ids = sorted(family_ids)
+        # Look up the families by primary key, in chunks below SQLite's limit on parameters:
+        for i in range(0, len(family_ids), 500):
+            chunk = family_ids[i:i + 500]
+            families.extend(db.execute(
+                'SELECT ord, id, level, newick FROM family WHERE id IN ({0})'.format(
+                    ', '.join('?' * len(chunk))),
+                chunk))
+        families = [row[1:] for row in sorted(families)]
+    finally:
+        db.close()
+
     glob = Tree()
     glob.name = 'glottolog_global'
 
-    for family in families:
-        node = family.newick_node(nodes=languoids)
-        node.visit(rename)
-        langs_in_tree = set(n.name for n in node.walk())
+    for family_id, level, newick in families:
+        tree = Tree("({0});".format(newick), format=3)
+        langs_in_tree = set(n.name for n in tree.traverse() if n is not tree)
         langs_selected = glottocodes.intersection(langs_in_tree)
 
         if not langs_selected:
             continue
 
-        tree = Tree("({0});".format(node.newick), format=3)
-        tree.name = 'glottolog_{0}'.format(family.id)
+        tree.name = 'glottolog_{0}'.format(family_id)
 
-        if family.level.name == 'family':
+        if level == 'family':
             tree.prune([n for n in langs_selected], preserve_branch_length=False)
             glottocodes_in_global_tree = glottocodes_in_global_tree.union(
                 set(n.name for n in tree.traverse()))
@@ -56,3 +143,31 @@ def tree(glottocodes, gl_repos):
     glob.prune([n for n in nodes])
 
     return glob.write(format=9), nodes
+
+
+class TreeSlicer(object):
+    """
+    Extracts pruned subtrees for sets of nodes from a tree which is parsed only once.
+
+    `TreeSlicer(newick).prune(names)` returns the same newick as pruning the full tree, i.e.
+    `t = Tree(newick, format=1); t.prune(names); t.write(format=9)`, but only copies and prunes
+    the subtree below the common ancestor of the nodes.
+    """
+    def __init__(self, newick):
+        self.tree = Tree(newick, format=1)
+        self.nodes = {n.name: n for n in self.tree.traverse() if n.name}
+
+    def prune(self, names):
+        nodes = [self.nodes[name] for name in names if name in self.nodes]
+        if not nodes:
+            raise TreeError('Nodes are not connected!')
+        if len(nodes) == 1 and nodes[0].is_leaf():
+            return '({0});'.format(nodes[0].name)
+        ancestor = self.tree.get_common_ancestor(nodes) if len(nodes) > 1 else nodes[0]
+        # Pruning keeps the root, in whose place the common ancestor of the nodes ends up -
+        # unless the ancestor is one of the nodes itself, which then keeps its parent as root.
+        if ancestor in nodes and ancestor.up:
+            ancestor = ancestor.up
+        t = ancestor.copy()
+        t.prune([n.name for n in nodes], preserve_branch_length=False)
+        return t.write(format=9)
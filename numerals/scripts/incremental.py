@@ -0,0 +1,47 @@
+"""
+Results of prime_cache which are kept across loads of the data.
+
+`clld initdb` loads the data into a fresh database, so everything prime_cache computed for a
+previous load is gone. With `numerals.prime_cache_state` set, the results of the costly steps
+are stored in an SQLite file instead, keyed by what they are computed from:
+
+- the statistics of a contribution by its fingerprint, i.e. ID, version, DOI and row counts,
+- the global tree and the family trees by the glottocodes they contain,
+
+and both by the Glottolog version. Since primary keys change with each load, the stored
+results refer to languages and parameters by ID.
+"""
+import json
+import hashlib
+
+from numerals.cache import SqliteStore
+
+
+class PrimeCacheState(object):
+    def __init__(self, path, glottolog_version):
+        self.store = SqliteStore(path)
+        self.glottolog_version = glottolog_version
+        self.items = {}
+
+    def key(self, kind, key):
+        return '{0} {1} {2}'.format(
+            kind,
+            self.glottolog_version,
+            hashlib.sha1(json.dumps(key).encode('utf8')).hexdigest())
+
+    def get(self, kind, key):
+        key = self.key(kind, key)
+        value = self.store.get(key)
+        if value is not None:
+            self.items[key] = value
+            return json.loads(value)
+
+    def set(self, kind, key, value):
+        self.items[self.key(kind, key)] = json.dumps(value)
+
+    def save(self):
+        """
+        Store the results of the current load - dropping those which weren't used.
+        """
+        self.store.clear()
+        self.store.update(self.items.items())
@@ -1,9 +1,12 @@
 import ete3
 import json
+import collections
 import pycldf
 import re
+import time
 import unicodedata
 import itertools
+import uuid
 
 from clldutils import color
 from clldutils.misc import slug
@@ -15,15 +18,22 @@ from clld.cliutil import Data, add_language_codes, bibtex2source
 from clld_glottologfamily_plugin.util import load_families
 from clld_glottologfamily_plugin.models import Family
 from clld_phylogeny_plugin.models import Phylogeny, LanguageTreeLabel, TreeLabel
-from sqlalchemy import func
+from sqlalchemy import distinct, func
 from datetime import date
 from pycldf import Wordlist
 from pyconcepticon import Concepticon
 from pylexibank import progressbar
+from pyramid.settings import asbool
 
 import numerals
 from numerals import models
-from numerals.scripts.global_tree import tree
+from numerals.adapters import prune_newick, tree_cache_key
+from numerals.cache import SqliteStore
+from numerals.prerendered import render_geojson
+from numerals.search import create_search_index
+from numerals.scripts.global_tree import TreeSlicer, glottolog_version, tree
+from numerals.scripts.incremental import PrimeCacheState
+from numerals.scripts.loader import BulkLoader, Timer, iter_forms, iter_forms_parallel, lexeme
 
 
 NUMERALS_RDFID = 'numerals'
@@ -86,6 +96,7 @@ def main(args):
         "-1",
         id="-1",
         name="Base",
+        number=-1,
     )
     DBSession.flush()
 
@@ -151,6 +162,7 @@ def main(args):
                 pid,
                 id=pid,
                 name=pid,
+                number=int(pid) if pid.isdigit() else None,
                 concepticon_id=parameter[ns.parameters.concepticonReference],
             )
 
@@ -159,8 +171,9 @@ def main(args):
     except AttributeError:
         sep = ""
 
+    languages = list(ds["LanguageTable"])
     load_family_langs = []
-    for language in ds["LanguageTable"]:
+    for language in languages:
 
         if ns.languages.contributor in language:
             if sep:
@@ -200,7 +213,7 @@ def main(args):
             args.log.warn("Language ID '{0}' already exists".format(lg_id))
 
     # Add Base info if given
-    for language in ds["LanguageTable"]:
+    for language in languages:
         lg_id = language[ns.languages.id]
         if "BaseAnnotation" in language and language["BaseAnnotation"]:
             basis = language["BaseAnnotation"]
@@ -230,46 +243,54 @@ def main(args):
 
     DBSession.flush()
 
-    for form in progressbar(ds["FormTable"], desc="Processing data"):
-
-        if form[ns.forms.parameterReference] not in param_map:
+    bulk = asbool(args.settings.get('numerals.bulk_load', False))
+    if bulk:
+        loader = BulkLoader(batch_size=int(args.settings.get('numerals.bulk_batch_size', 10000)))
+    processes = int(args.settings.get('numerals.reader_processes', 0))
+    if processes:
+        forms = iter_forms_parallel(
+            ds,
+            param_map,
+            processes=processes,
+            chunksize=int(args.settings.get('numerals.reader_chunksize', 5000)))
+    else:
+        forms = iter_forms(ds, param_map)
+    timer = Timer(args.log, 'Loaded')
+
+    for form in progressbar(forms, desc="Processing data"):
+        if form.language_id not in data["Variety"]:
+            args.log.warn("Form '{0}' has unknown language '{1}'".format(
+                form.id, form.language_id))
             continue
 
-        formpid = param_map[form[ns.forms.parameterReference]]
-        valueset_id = "{0}-{1}".format(formpid, form[ns.forms.languageReference])
-        valueset = data["ValueSet"].get(valueset_id)
+        if bulk:
+            vs = loader.valuesets.get(form.valueset_id)
+        else:
+            vs = data["ValueSet"].get(form.valueset_id)
 
         # Unless we already have something in the VS:
-        if not valueset:
-            lg_id = form[ns.forms.languageReference]
-            if lg_id in data["Variety"]:
-                src = None
-                if form[ns.forms.source]:
-                    src = ",".join(form[ns.forms.source])
-                vs = data.add(
-                    common.ValueSet,
-                    valueset_id,
-                    id=valueset_id,
-                    language=data["Variety"][lg_id],
-                    parameter=data["NumberParameter"][formpid],
-                    contribution=contribs[form[ns.forms.languageReference].split("-")[0]],
-                    source=src,
-                )
-
-        DBSession.add(
-            models.NumberLexeme(
-                id=form[ns.forms.id],
-                name=form[ns.forms.form],
-                comment=form[ns.forms.comment],
-                is_loan=form["Loan"] if "Loan" in form else None,
-                other_form=form[ns.forms.value],
-                org_form=None,
-                is_problematic=form["Problematic"] if "Problematic" in form else None,
-                valueset=vs,
+        if not vs:
+            kw = dict(
+                language=data["Variety"][form.language_id],
+                parameter=data["NumberParameter"][form.parameter_id],
+                contribution=contribs[form.language_id.split("-")[0]],
+                source=form.source,
             )
-        )
+            if bulk:
+                vs = loader.add_valueset(form.valueset_id, **kw)
+            else:
+                vs = data.add(common.ValueSet, form.valueset_id, id=form.valueset_id, **kw)
 
+        if bulk:
+            loader.add_lexeme(form, vs)
+        else:
+            DBSession.add(lexeme(form, vs))
+        timer.count += 1
+
+    if bulk:
+        loader.close()
     DBSession.flush()
+    timer.report()
 
     args.log.info('Processing families')
     load_families(
@@ -284,8 +305,17 @@ def main(args):
         zip([r[0] for r in distinct_varieties], color.qualitative_colors(len(distinct_varieties)))
     )
 
+    codes = collections.defaultdict(dict)
+    for lpk, type_, name in DBSession.query(
+            common.LanguageIdentifier.language_pk, common.Identifier.type, common.Identifier.name)\
+            .join(common.LanguageIdentifier.identifier)\
+            .order_by(common.LanguageIdentifier.pk):
+        codes[lpk].setdefault(type_, name)
+
     for lg in DBSession.query(models.Variety):
         lg.jsondata = {"color": families[lg.family_pk]}
+        lg.glottocode = codes[lg.pk].get(common.IdentifierType.glottolog.value)
+        lg.iso_code = codes[lg.pk].get(common.IdentifierType.iso.value)
 
     p = common.Parameter.get("-1")
     colors = color.qualitative_colors(len(p.domain))
@@ -294,70 +324,175 @@ def main(args):
         de.jsondata = {"color": colors[i]}
 
 
-def prime_cache(args):
-
-    # add number of data points per parameter
-    for np in DBSession.query(common.Parameter, func.count(common.Parameter.pk)) \
-            .join(common.ValueSet) \
-            .join(common.Value) \
-            .group_by(models.NumberParameter.pk, common.Parameter.pk):
-        np[0].count_of_datapoints = np[1]
-
-    # add number of distinct varieties per parameter based on assigned glottocodes
-    for np in DBSession.query(models.NumberParameter, func.count(common.Identifier.name)) \
-            .join(common.ValueSet) \
-            .join(common.Value) \
-            .join(common.Language, common.ValueSet.language_pk == common.Language.pk) \
-            .join(common.LanguageIdentifier) \
-            .join(common.Identifier) \
-            .filter(common.Identifier.type == common.IdentifierType.glottolog.value) \
-            .group_by(models.NumberParameter.pk, common.Parameter.pk):
-        np[0].count_of_varieties = np[1]
-
-    # add number of data points of parameter "base"
-    base_pk, cnt_base = DBSession.query(common.Parameter.pk, func.count(common.ValueSet.pk)) \
-        .join(common.Parameter) \
-        .filter(common.Parameter.name == 'Base') \
-        .group_by(common.Parameter.pk).all()[0]
-    for np in DBSession.query(models.Parameter) \
-            .filter(common.Parameter.pk == base_pk):
-        np.count_of_datapoints = cnt_base
-        break
-
+def provider_stats(contribution_pks=None):
+    """
+    Compute (language_pks, parameter count, lexeme count) for all - or the selected -
+    contributions at once.
+    """
+    res = {}
+    q = DBSession.query(
+        common.ValueSet.contribution_pk,
+        func.count(distinct(common.ValueSet.parameter_pk)),
+        func.count(common.Value.pk))\
+        .outerjoin(common.Value)\
+        .group_by(common.ValueSet.contribution_pk)
+    if contribution_pks is not None:
+        q = q.filter(common.ValueSet.contribution_pk.in_(contribution_pks))
+    for cpk, pcnt, lcnt in q:
+        res[cpk] = ([], pcnt, lcnt)
+    q = DBSession.query(common.ValueSet.contribution_pk, common.ValueSet.language_pk)\
+        .distinct()\
+        .order_by(common.ValueSet.contribution_pk, common.ValueSet.language_pk)
+    if contribution_pks is not None:
+        q = q.filter(common.ValueSet.contribution_pk.in_(contribution_pks))
+    for cpk, lpk in q:
+        res[cpk][0].append(lpk)
+    return res
+
+
+def provider_stats_per_provider():
+    """
+    The equivalent of `provider_stats`, running separate queries per contribution.
+
+    Only used to report the speed-up when `numerals.profile_prime_cache` is set.
+    """
+    res = {}
     for prov in DBSession.query(models.Provider):
         q = DBSession.query(common.ValueSet.language_pk)\
             .filter(common.ValueSet.contribution_pk == prov.pk)\
-            .distinct()
-        prov.language_count = q.count()
-        prov.update_jsondata(language_pks=[r[0] for r in q])
-
+            .distinct()\
+            .order_by(common.ValueSet.language_pk)
+        language_pks = [r[0] for r in q]
+        if not language_pks:
+            continue
         pcnt = DBSession.query(common.ValueSet.parameter_pk) \
             .filter(common.ValueSet.contribution_pk == prov.pk) \
             .distinct() \
             .count()
-
-        prov.parameter_count = pcnt
         lcnt = DBSession.query(common.Value.pk)\
             .join(common.ValueSet)\
             .filter(common.ValueSet.contribution_pk == prov.pk)\
             .count()
-        if prov.id == 'numerals':
-            # do not count 'base lexemes'
-            lcnt -= cnt_base
-        prov.lexeme_count = lcnt
-
-    DBSession.query(LanguageTreeLabel).delete()
-    DBSession.query(TreeLabel).delete()
-    DBSession.query(Phylogeny).delete()
-
-    langs = [lg for lg in DBSession.query(common.Language) if lg.glottocode]
-
-    newick, _ = tree(
-        [lg.glottocode for lg in langs], gl_repos=args.glottolog
-    )
+        res[prov.pk] = (language_pks, pcnt, lcnt)
+    return res
+
+
+def parameter_counts(contribution_pks=None):
+    """
+    Count the data points, and those of varieties with a glottocode, per parameter for all - or
+    the selected - contributions.
+
+    Returns a dict mapping contribution pks to pairs of dicts, mapping parameter IDs to counts.
+    """
+    res = collections.defaultdict(lambda: ({}, {}))
+    datapoints = DBSession.query(
+        common.ValueSet.contribution_pk, common.Parameter.id, func.count(common.Value.pk)) \
+        .select_from(common.ValueSet) \
+        .join(common.ValueSet.parameter) \
+        .join(common.Value) \
+        .group_by(common.ValueSet.contribution_pk, common.Parameter.id)
+    varieties = DBSession.query(
+        common.ValueSet.contribution_pk, common.Parameter.id, func.count(common.Identifier.name)) \
+        .select_from(common.ValueSet) \
+        .join(common.ValueSet.parameter) \
+        .join(common.Value) \
+        .join(common.Language, common.ValueSet.language_pk == common.Language.pk) \
+        .join(common.LanguageIdentifier) \
+        .join(common.Identifier) \
+        .filter(common.Identifier.type == common.IdentifierType.glottolog.value) \
+        .group_by(common.ValueSet.contribution_pk, common.Parameter.id)
+    for i, q in enumerate([datapoints, varieties]):
+        if contribution_pks is not None:
+            q = q.filter(common.ValueSet.contribution_pk.in_(contribution_pks))
+        for cpk, pid, n in q:
+            res[cpk][i][pid] = n
+    return dict(res)
+
+
+def update_parameter_counts(counts):
+    """
+    Set the counters of all parameters from the `parameter_counts` of all contributions,
+    returning the number of data points of "Base".
+    """
+    datapoints, varieties = collections.Counter(), collections.Counter()
+    for dp, var in counts.values():
+        datapoints.update(dp)
+        varieties.update(var)
+    for np in DBSession.query(models.NumberParameter):
+        if np.id in datapoints:
+            np.count_of_datapoints = datapoints[np.id]
+        if np.id in varieties:
+            np.count_of_varieties = varieties[np.id]
 
+    # add number of data points of parameter "base"
+    base_pk, cnt_base = DBSession.query(common.Parameter.pk, func.count(common.ValueSet.pk)) \
+        .join(common.Parameter) \
+        .filter(common.Parameter.name == 'Base') \
+        .group_by(common.Parameter.pk).all()[0]
+    for np in DBSession.query(models.Parameter) \
+            .filter(common.Parameter.pk == base_pk):
+        np.count_of_datapoints = cnt_base
+        break
+    return cnt_base
+
+
+def contribution_stats(state=None, log=None):
+    """
+    Compute the `provider_stats` and the `parameter_counts` of all contributions.
+
+    With a `PrimeCacheState`, only contributions which changed since a previous load are
+    queried, the results for the others are taken from the state.
+    """
+    if state is None:
+        return provider_stats(), parameter_counts()
+
+    fingerprints = {}
+    for pk, id_, version, doi, nvaluesets, nvalues in DBSession.query(
+            models.Provider.pk,
+            models.Provider.id,
+            models.Provider.version,
+            models.Provider.doi,
+            func.count(distinct(common.ValueSet.pk)),
+            func.count(common.Value.pk))\
+            .outerjoin(common.ValueSet, common.ValueSet.contribution_pk == models.Provider.pk)\
+            .outerjoin(common.Value)\
+            .group_by(models.Provider.pk):
+        fingerprints[pk] = [id_, version, doi, nvaluesets, nvalues]
+    stored = {pk: state.get('contribution', fp) for pk, fp in fingerprints.items()}
+    changed = [pk for pk, res in stored.items() if res is None]
+    if log:
+        log.info('Computing statistics for {0} of {1} contributions'.format(
+            len(changed), len(fingerprints)))
+
+    stats, counts = provider_stats(changed), parameter_counts(changed)
+    language_ids = dict(DBSession.query(common.Language.pk, common.Language.id))
+    language_pks = {id_: pk for pk, id_ in language_ids.items()}
+    for pk, fp in fingerprints.items():
+        if stored[pk] is None:
+            lpks, pcnt, lcnt = stats.get(pk, ([], 0, 0))
+            datapoints, varieties = counts.get(pk, ({}, {}))
+            state.set('contribution', fp, dict(
+                languages=[language_ids[lpk] for lpk in lpks],
+                parameter_count=pcnt,
+                lexeme_count=lcnt,
+                datapoints=datapoints,
+                varieties=varieties))
+            continue
+        res = stored[pk]
+        # Like the queries, only list contributions with data:
+        if res['languages']:
+            stats[pk] = (
+                sorted(language_pks[id_] for id_ in res['languages']),
+                res['parameter_count'],
+                res['lexeme_count'])
+        if res['datapoints'] or res['varieties']:
+            counts[pk] = (res['datapoints'], res['varieties'])
+    return stats, counts
+
+
+def glottolog_metadata(glottolog):
     try:
-        with open(args.glottolog / '.zenodo.json') as f:
+        with open(glottolog / '.zenodo.json') as f:
             gljson = json.load(f)
         gltree_description = gljson['description']
         gltree_version = ' (Glottolog {0})'.format(
@@ -365,6 +500,31 @@ def prime_cache(args):
     except (FileNotFoundError, AttributeError):
         gltree_description = ''
         gltree_version = ''
+    return gltree_description, gltree_version
+
+
+def update_trees(args, state=None):
+    """
+    Build the global tree and the family trees pruned from it - or take them from `state`.
+    """
+    gltree_description, gltree_version = glottolog_metadata(args.glottolog)
+
+    DBSession.query(LanguageTreeLabel).delete()
+    DBSession.query(TreeLabel).delete()
+    DBSession.query(Phylogeny).delete()
+
+    langs = [lg for lg in DBSession.query(common.Language) if lg.glottocode]
+
+    glottocodes = sorted(set(lg.glottocode for lg in langs))
+    newick = state.get('tree', ['global', glottocodes]) if state else None
+    if newick is None:
+        newick, _ = tree(
+            glottocodes,
+            gl_repos=args.glottolog,
+            cache_dir=args.settings.get('numerals.glottolog_cache'),
+        )
+        if state:
+            state.set('tree', ['global', glottocodes], newick)
 
     phylo = Phylogeny(
         id="globaltree",
@@ -382,28 +542,36 @@ def prime_cache(args):
         )
     DBSession.add(phylo)
 
+    langs_by_family = collections.defaultdict(list)
+    for lg in langs:
+        langs_by_family[lg.family_pk].append(lg)
+    slicer = None
+
     families = DBSession.query(Family.pk, Family.name).all()
     p_pk = 1
     for f in families:
-        langs_in_family = [lg for lg in langs if lg.family_pk == f[0]]
+        langs_in_family = langs_by_family[f[0]]
         if len(langs_in_family) == 0:
             continue
         nodes = set([lg.glottocode for lg in langs_in_family])
+        key = ['family', sorted(nodes)]
+        family_newick = state.get('tree', key) if state else None
         try:
             if len(nodes) == 1:
-                t = ete3.Tree("({0});".format(list(nodes)[0]), format=1)
-            else:
-                t = ete3.Tree(newick, format=1)
-                t.prune(
-                    nodes.intersection(set(n.name for n in t.traverse())),
-                    preserve_branch_length=False)
+                family_newick = "({0});".format(list(nodes)[0])
+            elif family_newick is None:
+                # The global tree is only parsed if any family tree must be computed.
+                slicer = slicer or TreeSlicer(newick)
+                family_newick = slicer.prune(nodes)
+                if state:
+                    state.set('tree', key, family_newick)
         except ete3.coretype.tree.TreeError as e:
             args.log.info("No tree for '{0}' due to {1}".format(f[1], e))
             continue
         phylo = Phylogeny(
             id=slug(f[1]),
             name="{1} Tree{0}".format(gltree_version, f[1]),
-            newick=t.write(format=9),
+            newick=family_newick,
             description=gltree_description
         )
         p_pk += 1
@@ -413,3 +581,78 @@ def prime_cache(args):
                                                  name=lg.glottocode, phylogeny=phylo)
             )
         DBSession.add(phylo)
+
+
+def prime_cache(args):
+    state = None
+    if args.settings.get('numerals.prime_cache_state'):
+        gl_version = glottolog_version(args.glottolog)
+        if gl_version:
+            state = PrimeCacheState(args.settings['numerals.prime_cache_state'], gl_version)
+        else:
+            args.log.warning('Unknown Glottolog version, recomputing all statistics and trees')
+
+    start = time.time()
+    stats, counts = contribution_stats(state, log=args.log)
+    args.log.info('Provider statistics computed in {0:.2f}s'.format(time.time() - start))
+    cnt_base = update_parameter_counts(counts)
+    if asbool(args.settings.get('numerals.profile_prime_cache', False)):
+        start = time.time()
+        per_provider = provider_stats_per_provider()
+        args.log.info('Per-provider queries would take {0:.2f}s'.format(time.time() - start))
+        if per_provider != stats:
+            raise ValueError('Per-provider statistics differ from the grouped ones')
+
+    for prov in DBSession.query(models.Provider):
+        language_pks, pcnt, lcnt = stats.get(prov.pk, ([], 0, 0))
+        prov.language_count = len(language_pks)
+        prov.update_jsondata(language_pks=language_pks)
+        prov.parameter_count = pcnt
+        if prov.id == 'numerals':
+            # do not count 'base lexemes'
+            lcnt -= cnt_base
+        prov.lexeme_count = lcnt
+
+    update_trees(args, state)
+    if state:
+        state.save()
+    create_search_index(log=args.log)
+
+    version = uuid.uuid4().hex
+    DBSession.query(common.Dataset).one().update_jsondata(data_version=version)
+    warm = asbool(args.settings.get('numerals.warm_tree_cache', False))
+    if args.settings.get('numerals.tree_cache'):
+        store = SqliteStore(args.settings['numerals.tree_cache'])
+        # Trees stored for previous data versions can't be requested anymore:
+        store.clear()
+        if warm:
+            DBSession.flush()
+            warm_tree_cache(store, version)
+    elif warm:
+        args.log.warning('numerals.warm_tree_cache is set, but numerals.tree_cache is not')
+    if args.settings.get('numerals.page_cache_store'):
+        # Pages are stored per data version, too:
+        SqliteStore(args.settings['numerals.page_cache_store']).clear()
+    if args.settings.get('numerals.geojson_dir') and getattr(args, 'env', None):
+        # Files from a previous load must not be served for the new data:
+        DBSession.flush()
+        render_geojson(args.env['app'], args.settings['numerals.geojson_dir'], log=args.log)
+
+
+def warm_tree_cache(store, version):
+    """
+    Store the pruned trees for all single parameters, as requested by `NumeralbankTree`.
+    """
+    names = collections.defaultdict(set)
+    q = DBSession.query(Phylogeny.id, common.Parameter.id, TreeLabel.name)\
+        .join(TreeLabel, TreeLabel.phylogeny_pk == Phylogeny.pk)\
+        .join(LanguageTreeLabel, LanguageTreeLabel.treelabel_pk == TreeLabel.pk)\
+        .join(common.ValueSet, common.ValueSet.language_pk == LanguageTreeLabel.language_pk)\
+        .join(common.Parameter, common.Parameter.pk == common.ValueSet.parameter_pk)\
+        .distinct()
+    for phylo_id, param_id, name in q:
+        names[phylo_id, param_id].add(name)
+    newicks = dict(DBSession.query(Phylogeny.id, Phylogeny.newick))
+    store.update(
+        (tree_cache_key(phylo_id, [param_id], version), prune_newick(newicks[phylo_id], n))
+        for (phylo_id, param_id), n in names.items())
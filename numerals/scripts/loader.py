@@ -0,0 +1,233 @@
+"""
+Loading of the CLDF FormTable into the value, numberlexeme and valueset tables.
+"""
+import os
+import time
+import pathlib
+import itertools
+import collections
+import concurrent.futures
+
+from clld.db.meta import DBSession
+from csvw.dsv import UnicodeReader
+from clld.db.models import common
+from sqlalchemy import func, text
+
+from numerals import models
+from numerals.util import normalize_form
+
+
+FormRow = collections.namedtuple('FormRow', [
+    'id',
+    'name',
+    'comment',
+    'is_loan',
+    'other_form',
+    'is_problematic',
+    'language_id',
+    'parameter_id',
+    'valueset_id',
+    'source',
+])
+
+
+def form_row(form, ns, param_map):
+    """
+    Convert a FormTable row into a `FormRow`, or `None` if the form does not map to a numeral.
+    """
+    pid = param_map.get(form[ns.forms.parameterReference])
+    if pid is None:
+        return None
+    lg_id = form[ns.forms.languageReference]
+    return FormRow(
+        id=form[ns.forms.id],
+        name=form[ns.forms.form],
+        comment=form[ns.forms.comment],
+        is_loan=form["Loan"] if "Loan" in form else None,
+        other_form=form[ns.forms.value],
+        is_problematic=form["Problematic"] if "Problematic" in form else None,
+        language_id=lg_id,
+        parameter_id=pid,
+        valueset_id="{0}-{1}".format(pid, lg_id),
+        source=",".join(form[ns.forms.source]) if form[ns.forms.source] else None,
+    )
+
+
+def lexeme(row, valueset):
+    """
+    The `NumberLexeme` for a `FormRow`, as loaded through the ORM.
+    """
+    return models.NumberLexeme(
+        id=row.id,
+        name=row.name,
+        comment=row.comment,
+        is_loan=row.is_loan,
+        other_form=row.other_form,
+        org_form=None,
+        normalized_form=normalize_form(row.name),
+        is_problematic=row.is_problematic,
+        valueset=valueset,
+    )
+
+
+def iter_forms(ds, param_map):
+    ns = ds.column_names
+    for form in ds["FormTable"]:
+        row = form_row(form, ns, param_map)
+        if row:
+            yield row
+
+
+# State of a reader worker process, set up once by `_init_reader`:
+_reader = {}
+
+
+def _init_reader(columns, header, ns, param_map):
+    columns = {col.header: col for col in columns}
+    _reader.update(
+        columns=[(name, columns.get(name)) for name in header],
+        missing=[name for name in columns if name not in header],
+        ns=ns,
+        param_map=param_map,
+    )
+
+
+def _read_chunk(rows):
+    res = []
+    for row in rows:
+        form = {
+            name: col.read(v) if col else v for (name, col), v in zip(_reader['columns'], row)}
+        form.update((name, None) for name in _reader['missing'])
+        form = form_row(form, _reader['ns'], _reader['param_map'])
+        if form:
+            res.append(form)
+    return res
+
+
+def iter_forms_parallel(ds, param_map, processes=None, chunksize=5000):
+    """
+    Parse the FormTable in chunks on a process pool.
+
+    The raw CSV rows are split into chunks by this process, while datatype conversion, the
+    `param_map` filter and the derivation of valueset IDs happen in the workers. At most two
+    chunks per worker are in flight, so memory use does not grow with the size of the table,
+    and the consumer of the yielded `FormRow`s works while the next chunks are parsed.
+    """
+    table = ds["FormTable"]
+    fname = pathlib.Path(str(table.url.resolve(table.base)))
+    if not fname.exists():  # e.g. a zipped table, which we leave to csvw.
+        for row in iter_forms(ds, param_map):
+            yield row
+        return
+
+    processes = processes or os.cpu_count() or 1
+    with UnicodeReader(fname, dialect=table.dialect or ds.tablegroup.dialect) as reader:
+        rows = iter(reader)
+        header = next(rows)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_reader,
+            initargs=(table.tableSchema.columns, header, ds.column_names, param_map),
+        ) as pool:
+            pending = collections.deque()
+            while True:
+                chunk = list(itertools.islice(rows, chunksize))
+                if chunk:
+                    pending.append(pool.submit(_read_chunk, chunk))
+                if pending and (len(pending) >= 2 * processes or not chunk):
+                    for row in pending.popleft().result():
+                        yield row
+                elif not chunk:
+                    break
+
+
+class Timer(object):
+    def __init__(self, log, what):
+        self.log = log
+        self.what = what
+        self.count = 0
+        self.start = time.time()
+
+    def report(self):
+        secs = max(time.time() - self.start, 1e-6)
+        self.log.info('{0} {1} rows in {2:.1f}s ({3:.0f} rows/s)'.format(
+            self.what, self.count, secs, self.count / secs))
+
+
+class BulkLoader(object):
+    """
+    Writes valueset, value and numberlexeme rows in batches through Core `executemany`.
+
+    Primary keys are allocated here rather than by the database, so that numberlexeme rows
+    can reference their value rows without a round trip per batch.
+    """
+    def __init__(self, batch_size=10000):
+        self.batch_size = batch_size
+        self.valuesets = {}
+        self.pks = {
+            model: DBSession.query(func.max(model.pk)).scalar() or 0
+            for model in [common.ValueSet, common.Value]}
+        self.rows = collections.OrderedDict(
+            (table, []) for table in [
+                common.ValueSet.__table__,
+                common.Value.__table__,
+                models.NumberLexeme.__table__,
+            ])
+
+    def next_pk(self, model):
+        self.pks[model] += 1
+        return self.pks[model]
+
+    def add_valueset(self, id_, language, parameter, contribution, source):
+        pk = self.next_pk(common.ValueSet)
+        self.valuesets[id_] = pk
+        self.rows[common.ValueSet.__table__].append(dict(
+            pk=pk,
+            id=id_,
+            language_pk=language.pk,
+            parameter_pk=parameter.pk,
+            contribution_pk=contribution.pk,
+            source=source,
+            polymorphic_type='base',
+            jsondata={},
+        ))
+        return pk
+
+    def add_lexeme(self, row, valueset_pk):
+        pk = self.next_pk(common.Value)
+        self.rows[common.Value.__table__].append(dict(
+            pk=pk,
+            id=row.id,
+            name=row.name,
+            valueset_pk=valueset_pk,
+            polymorphic_type='custom',
+            jsondata={},
+        ))
+        self.rows[models.NumberLexeme.__table__].append(dict(
+            pk=pk,
+            comment=row.comment,
+            # Unlike the ORM, Core does not apply the column defaults to explicit `None`s:
+            is_loan=bool(row.is_loan),
+            other_form=row.other_form,
+            org_form=None,
+            normalized_form=normalize_form(row.name),
+            is_problematic=bool(row.is_problematic),
+        ))
+        if len(self.rows[common.Value.__table__]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # Tables are written in dependency order, so foreign keys are always satisfied.
+        for table, rows in self.rows.items():
+            if rows:
+                DBSession.execute(table.insert(), rows)
+                del rows[:]
+
+    def close(self):
+        self.flush()
+        if DBSession.get_bind().dialect.name == 'postgresql':
+            # We bypassed the sequences when allocating primary keys, so we must catch up.
+            for model in self.pks:
+                DBSession.execute(text(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'pk'), {1})".format(
+                        model.__tablename__, max(self.pks[model], 1))))
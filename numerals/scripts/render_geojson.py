@@ -0,0 +1,28 @@
+"""
+Pre-render the GeoJSON for the parameter maps, to be served from `numerals.geojson_dir`.
+"""
+import logging
+import argparse
+
+from pyramid.paster import bootstrap, setup_logging
+
+from numerals.prerendered import render_geojson
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('config_uri', help='ini file providing app config')
+    parser.add_argument(
+        '--directory', default=None, help='output directory [numerals.geojson_dir]')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    with bootstrap(args.config_uri) as env:
+        directory = args.directory or env['registry'].settings.get('numerals.geojson_dir')
+        if not directory:
+            parser.error('no output directory given and numerals.geojson_dir not set')
+        render_geojson(env['app'], directory, log=logging.getLogger(__name__))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,42 @@
+"""
+Write a static mirror of the site, to be served by a plain file server.
+"""
+import os
+import logging
+import argparse
+
+from pyramid.paster import bootstrap, setup_logging
+
+from numerals.snapshot import snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('config_uri', help='ini file providing app config')
+    parser.add_argument('directory', help='output directory')
+    parser.add_argument(
+        '--processes', type=int, default=os.cpu_count(),
+        help='number of rendering processes, 0 to render in this process [%(default)s]')
+    parser.add_argument(
+        '--chunksize', type=int, default=200, help='pages per task [%(default)s]')
+    parser.add_argument(
+        '--base-url',
+        default=None,
+        help='URL the mirror will be served at, used for the links in the pages, e.g. '
+             'https://numerals.clld.org [http://localhost]')
+    args = parser.parse_args(argv)
+
+    setup_logging(args.config_uri)
+    with bootstrap(args.config_uri) as env:
+        snapshot(
+            env,
+            args.config_uri,
+            args.directory,
+            processes=args.processes,
+            chunksize=args.chunksize,
+            base_url=args.base_url,
+            log=logging.getLogger(__name__))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,78 @@
+"""
+Indexed substring search on forms and comments.
+
+On PostgreSQL, trigram GIN indexes serve the ILIKE conditions created by `icontains`. On
+SQLite (e.g. for tests) the columns are copied to an FTS5 table with trigram tokenizer,
+which is searched instead.
+"""
+from clld.db.meta import DBSession
+from clld.db.models.common import Value
+from clld.db.util import contains, icontains
+from sqlalchemy import Column, Integer, MetaData, Table, Unicode, select, text
+from sqlalchemy.exc import DBAPIError
+
+# Searchable columns as (table, column) pairs; column names are the same in `value_fts`:
+SEARCH_COLUMNS = [
+    ('numberlexeme', 'normalized_form'), ('numberlexeme', 'other_form'), ('numberlexeme', 'comment')]
+
+value_fts = Table(
+    'value_fts',
+    MetaData(),  # Not part of the app's metadata, so it isn't created by `create_all`.
+    Column('rowid', Integer),
+    *[Column(col, Unicode) for _, col in SEARCH_COLUMNS])
+
+_has_fts = {}
+
+
+def create_search_index(log=None):
+    dialect = DBSession.get_bind().dialect.name
+    if dialect == 'postgresql':
+        try:
+            with DBSession.begin_nested():
+                DBSession.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        except DBAPIError as e:  # pragma: no cover
+            if log:
+                log.warning('pg_trgm not available, search is not indexed: {0}'.format(e))
+            return False
+        for table, col in SEARCH_COLUMNS:
+            DBSession.execute(text(
+                'CREATE INDEX IF NOT EXISTS {0}_{1}_trgm ON {0} USING gin ({1} gin_trgm_ops)'.format(
+                    table, col)))
+        return True
+    if dialect == 'sqlite':
+        DBSession.execute(text('DROP TABLE IF EXISTS value_fts'))
+        DBSession.execute(text(
+            "CREATE VIRTUAL TABLE value_fts USING fts5({0}, tokenize='trigram')".format(
+                ', '.join(col for _, col in SEARCH_COLUMNS))))
+        DBSession.execute(text(
+            'INSERT INTO value_fts (rowid, {0}) '
+            'SELECT value.pk, {1} FROM value '
+            'LEFT OUTER JOIN numberlexeme ON numberlexeme.pk = value.pk'.format(
+                ', '.join(col for _, col in SEARCH_COLUMNS),
+                ', '.join('{0}.{1}'.format(*tc) for tc in SEARCH_COLUMNS))))
+        return True
+    return False  # pragma: no cover
+
+
+def has_fts():
+    bind = DBSession.get_bind()
+    key = str(bind.url)
+    if key not in _has_fts:
+        _has_fts[key] = bind.dialect.name == 'sqlite' and bool(DBSession.execute(text(
+            "SELECT name FROM sqlite_master WHERE name = 'value_fts'")).scalar())
+    return _has_fts[key]
+
+
+def search(col, qs):
+    """
+    Case-insensitive substring search condition for a column, using the FTS5 table if possible.
+    """
+    column = col.expression
+    # Trigrams cannot serve shorter search strings. (SQLite also counts bytes rather than
+    # characters, thus wrongly returns no matches for e.g. 'aː'.)
+    if len(qs.strip('^$')) >= 3 \
+            and (column.table.name, column.name) in SEARCH_COLUMNS and has_fts():
+        # Trigram-tokenized FTS5 tables evaluate LIKE case-insensitively, using the index.
+        return Value.pk.in_(
+            select([value_fts.c.rowid]).where(contains(value_fts.c[column.name], qs)))
+    return icontains(col, qs)
@@ -0,0 +1,195 @@
+"""
+A static mirror of the site.
+
+Since the database is read-only after prime_cache, the pages of all resources can be rendered
+once, through the WSGI app, and written to files - together with gzip and (if the `brotli`
+package is installed) brotli compressed copies - to be served by a plain file server. Only
+DataTables' AJAX requests and trees for combinations of parameters need the app.
+
+A page `/languages/abc` is written to `languages/abc/index.html`, a representation like
+`/parameters/1.geojson` to `parameters/1.geojson`. The static assets are copied, too.
+
+A plain file server ignores query strings. Thus, the GeoJSON of the map layers is rendered
+for the `layer` the maps request, and the layers for the domain elements of a parameter are
+written to files of their own, e.g. `parameters/-1-decimal.geojson`, which the maps in the
+mirror link to.
+"""
+import gzip
+import shutil
+import logging
+import pathlib
+import multiprocessing
+import urllib.parse
+import concurrent.futures
+
+from clld.db.meta import DBSession
+from clld.db.models import common
+from clld_phylogeny_plugin.models import Phylogeny
+from pyramid.interfaces import IRoutesMapper, IStaticURLInfo
+from pyramid.paster import get_app
+from pyramid.path import AssetResolver
+from pyramid.request import Request
+from pyramid.response import Response
+
+from numerals.prerendered import geojson_name, geojson_path, iter_layers
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Marks the requests rendered for the mirror:
+SNAPSHOT = 'numerals.snapshot'
+# The ID of the single layer of the languages map, see `clld.web.maps.Map.get_layers`:
+LANGUAGES_LAYER = 'id'
+INDEX_ROUTES = [
+    'dataset', 'contributions', 'parameters', 'languages', 'sources', 'phylogenys', 'download']
+# model, route name, extensions of additional representations:
+RESOURCES = [
+    (common.Contribution, 'contribution', ['md.html']),
+    (common.Parameter, 'parameter', []),
+    (common.Language, 'language', ['snippet.html']),
+    (common.ValueSet, 'valueset', []),
+    (Phylogeny, 'phylogeny', []),
+    (common.Source, 'source', ['bib']),
+]
+
+
+def layer_path(parameter_id, domainelement_id=None):
+    """
+    The path of the GeoJSON file of a parameter map layer in the mirror.
+    """
+    return '/parameters/{0}'.format(
+        urllib.parse.quote(geojson_name(parameter_id, domainelement_id)[:-len('.gz')]))
+
+
+def iter_paths(req):
+    """
+    Yield the paths to render, or pairs (path to render, path in the mirror).
+    """
+    for route in INDEX_ROUTES:
+        yield req.route_path(route)
+    yield req.route_path('languages_alt', ext='geojson', _query=dict(layer=LANGUAGES_LAYER))
+    for pid, deid in iter_layers():
+        yield geojson_path(pid, deid), layer_path(pid, deid)
+    for model, route, exts in RESOURCES:
+        for id_, in DBSession.query(model.id).order_by(model.pk):
+            yield req.route_path(route, id=id_)
+            for ext in exts:
+                yield req.route_path(route + '_alt', id=id_, ext=ext)
+
+
+def snapshot_file(directory, path):
+    path = urllib.parse.unquote(urllib.parse.urlsplit(path).path).strip('/')
+    if '.' not in path.split('/')[-1]:
+        path = '/'.join([path, 'index.html']).lstrip('/')
+    return pathlib.Path(directory) / path
+
+
+def static_dirs(registry):
+    """
+    Yield pairs (URL path, directory) for the static views served by the app.
+    """
+    mapper = registry.getUtility(IRoutesMapper)
+    for url, spec, route_name, *_ in registry.getUtility(IStaticURLInfo).registrations:
+        if url is None:  # i.e. not served from an external URL
+            path = mapper.get_route(route_name).pattern.replace('*subpath', '')
+            yield path, pathlib.Path(AssetResolver().resolve(spec).abspath())
+
+
+def copy_static(registry, directory):
+    for path, src in static_dirs(registry):
+        target = pathlib.Path(directory) / path.strip('/')
+        shutil.copytree(str(src), str(target), dirs_exist_ok=True)
+
+
+def _write(path, data):
+    tmp = path.parent / (path.name + '.tmp')
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+def render_paths(app, paths, directory, log=None, base_url=None):
+    """
+    Render the pages at `paths` through `app` and write them to `directory`.
+
+    Links in the pages are absolute, thus `base_url` should be the URL the mirror is served at.
+    """
+    count = 0
+    for path in paths:
+        path, target = path if isinstance(path, tuple) else (path, path)
+        req = Request.blank(path, base_url=base_url)
+        req.environ[SNAPSHOT] = True
+        try:
+            res = req.get_response(app)
+        except Exception as e:  # pragma: no cover
+            # A page failing to render must not abort the snapshot.
+            res = Response(status=500, body=repr(e).encode('utf8'))
+        if res.status_int != 200:
+            if log:
+                log.warning('{0}: {1}'.format(path, res.status))
+            continue
+        fname = snapshot_file(directory, target)
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        _write(fname, res.body)
+        # A fixed mtime makes the files reproducible.
+        _write(fname.parent / (fname.name + '.gz'), gzip.compress(res.body, mtime=0))
+        if brotli:
+            _write(fname.parent / (fname.name + '.br'), brotli.compress(res.body))
+        count += 1
+    return count
+
+
+_app = None
+_directory = None
+_base_url = None
+
+
+def _init_renderer(config_uri, directory, base_url):
+    global _app, _directory, _base_url
+    _app = get_app(config_uri)
+    _directory = directory
+    _base_url = base_url
+
+
+def _render_chunk(paths):
+    try:
+        return render_paths(
+            _app, paths, _directory, log=logging.getLogger(__name__), base_url=_base_url)
+    finally:
+        DBSession.remove()
+
+
+def snapshot(
+        env, config_uri, directory, processes=None, chunksize=200, log=None, base_url=None):
+    """
+    Write a static mirror of the app bootstrapped in `env` to `directory`.
+
+    With `processes`, the pages are rendered by a pool of processes, each running its own
+    instance of the app configured in `config_uri`.
+    """
+    paths = list(iter_paths(env['request']))
+    if log:
+        log.info('{0} pages to render'.format(len(paths)))
+    if not processes:
+        count = render_paths(env['app'], paths, directory, log=log, base_url=base_url)
+    else:
+        chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+        count = 0
+        # Workers are spawned rather than forked, because they must not inherit the app and
+        # the database connections of this process - some plugins keep global state, which
+        # breaks when a second app is created in the same process.
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_renderer,
+            initargs=(config_uri, directory, base_url),
+        ) as pool:
+            for i, n in enumerate(pool.map(_render_chunk, chunks), start=1):
+                count += n
+                if log and i % 10 == 0:
+                    log.info('{0} of {1} chunks rendered'.format(i, len(chunks)))
+    copy_static(env['registry'], directory)
+    if log:
+        log.info('{0} pages written to {1}'.format(count, directory))
+    return count
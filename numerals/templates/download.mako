@@ -8,7 +8,7 @@
 </p>
 <table>
   <thead style="border-bottom:1px solid lightgray"><td>ID</td><td>Name (URL)</td><td>Version</td></thead>
-  % for p in u.get_contributions(False):
+  % for p in u.get_contributions(False, req=request):
   <tr>
     <td>${p.id}</td>
     <td>${h.external_link(url=p.accessURL, label=p.name, target="_new")}</td>
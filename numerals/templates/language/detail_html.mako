@@ -42,13 +42,16 @@ ${request.get_datatable('values', h.models.Value, language=ctx).render()}
             ${h.format_coordinates(ctx)}
         </%util:accordion_group>
         % endif
-        <% v, t = u.get_variety_links(request, ctx, 'glottocode') %>
+        <%
+            variety_links = u.get_all_variety_links(request, ctx)
+            v, t = variety_links['glottocode']
+        %>
         % if v:
           <%util:accordion_group eid="acc-var" parent="sidebar-accordion" title="${t}" open="${False}">
             ${v}
           </%util:accordion_group>
         % endif
-        <% v, t = u.get_variety_links(request, ctx, 'iso_code') %>
+        <% v, t = variety_links['iso_code'] %>
         % if v:
           <%util:accordion_group eid="acc-var-iso" parent="sidebar-accordion" title="${t}" open="${False}">
             ${v}
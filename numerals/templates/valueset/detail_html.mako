@@ -6,6 +6,9 @@
 
 <h2>${_('Value Set')} ${h.link(request, ctx.language)} - ${h.link(request, ctx.parameter)}</h2>
 
+${u.cached_fragment(request, ('valueset', ctx.id), lambda: capture(values))|n}
+
+<%def name="values()">
 % for i, value in enumerate(ctx.values):
 <div style="clear: right;">
     ${h.map_marker_img(request, value)}
@@ -21,6 +24,8 @@
     % endif
 </div>
 % endfor
+</%def>
+
 <%def name="sidebar()">
 <div class="well well-small">
 <dl>
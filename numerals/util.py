@@ -1,56 +1,104 @@
+import collections
+import unicodedata
+
+from pyramid.settings import asbool
 from clld.web.util.multiselect import CombinationMultiSelect
-from clld.db.meta import DBSession
-from clld.db.models.common import Language, Identifier, LanguageIdentifier, IdentifierType, Contribution
 from clld.web.util.htmllib import HTML
 from clld import RESOURCES
-from numerals.models import Provider
+from numerals.cache import get_cache
+
+
+# Stress and length marks - and commas - which are ignored when sorting and searching forms:
+FORM_MARKS = dict.fromkeys(map(ord, 'ˈːˌ,'))
+
+
+def normalize_form(form):
+    if form is None:
+        return None
+    return unicodedata.normalize('NFC', form).translate(FORM_MARKS)
 
 
 def phylogeny_detail_html(request=None, context=None, **kw):
     return {"ms": CombinationMultiSelect}
 
 
-def get_contributions(only_id=True):
-    if only_id:
-        return [
-            r[0] for r in DBSession.query(Contribution.id).order_by(Contribution.id)
-        ]
-    else:
-        return [
-            r for r in DBSession.query(Provider).order_by(Contribution.id)
-        ]
+def get_contributions(only_id=True, req=None):
+    """
+    Contribution IDs or - with `only_id=False` - `ProviderRecord`s, ordered by ID.
+    """
+    from numerals.lookups import get_lookups
 
+    lookups = get_lookups(req)
+    return list(lookups.contribution_ids if only_id else lookups.providers)
 
-def get_variety_links(request=None, context=None, idtype='glottocode', **kw):
-    if idtype == "glottocode":
-        IType = IdentifierType.glottolog.value
-        typename = "Glottocode"
-    elif idtype == "iso_code":
-        IType = IdentifierType.iso.value
-        typename = "ISO code"
-    else:
-        return ("", "")
 
-    if getattr(context, idtype, False):
-        q = DBSession.query(Language.id, Language.name)\
-            .join(LanguageIdentifier, Identifier)\
-            .filter(Identifier.name == getattr(context, idtype),
-                    Identifier.type == IType,
-                    Language.id != context.id).distinct().all()
+# Attribute of a variety -> (index of the languages by this code in the lookups, label):
+VARIETY_LINK_TYPES = collections.OrderedDict([
+    ('glottocode', ('glottocode_languages', "Glottocode")),
+    ('iso_code', ('iso_languages', "ISO code")),
+])
+
+
+def _variety_links(lookups, context):
+    res = {}
+    for idtype, (index, typename) in VARIETY_LINK_TYPES.items():
+        code = getattr(context, idtype, None)
+        q = [
+            lookups.languages[pk] for pk in sorted(set(getattr(lookups, index).get(code, ())))
+            if pk != context.pk] if code else []
         if len(q) == 0:
-            return ("", "")
-        res = ""
+            res[idtype] = ("", "")
+            continue
+        items = ""
         title_string = "Further variet"
         title_string += "ies " if len(q) > 1 else "y "
-        title_string += "linked to {1} “{0}”".format(getattr(context, idtype), typename)
+        title_string += "linked to {1} “{0}”".format(code, typename)
         for lg in q:
-            res += HTML.li(HTML.a(lg[1], href=lg[0]))
-        return (HTML.ul(res), title_string)
-    return ("", "")
+            items += HTML.li(HTML.a(lg.name, href=lg.id))
+        res[idtype] = (HTML.ul(items), title_string)
+    return res
+
+
+def get_all_variety_links(request=None, context=None, **kw):
+    """
+    The results of `get_variety_links` for all identifier types, looked up in the lookups and
+    rendered once per variety and data version.
+    """
+    from numerals.lookups import get_lookups
+
+    if request is None:
+        return _variety_links(get_lookups(), context)
+    return get_cache(request, 'fragments').get_or_create(
+        repr((data_version(request), 'variety_links', context.pk)),
+        lambda: _variety_links(get_lookups(request), context))
+
+
+def cached_fragment(request, key, render):
+    """
+    The HTML fragment returned by `render` - cached by data version and `key`, if
+    `numerals.cache_fragments` is set.
+    """
+    if not asbool(request.registry.settings.get('numerals.cache_fragments', False)):
+        return render()
+    return get_cache(request, 'fragments').get_or_create(
+        repr((data_version(request),) + tuple(key)), render)
+
+
+def get_variety_links(request=None, context=None, idtype='glottocode', **kw):
+    if idtype not in VARIETY_LINK_TYPES:
+        return ("", "")
+    return get_all_variety_links(request, context)[idtype]
 
 
 def dataset_detail_html(context=None, request=None, **kw):
     return dict(
         stats=context.get_stats(
             [rsc for rsc in RESOURCES if rsc.name in ['language', 'parameter', 'value']])
-    )
\ No newline at end of file
+    )
+
+
+def data_version(req):
+    """
+    Identifier of the data loaded into the database, which changes with each prime_cache run.
+    """
+    return req.dataset.jsondata.get('data_version', '')
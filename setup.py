@@ -47,9 +47,15 @@ setup(
             'selenium',
             'zope.component>=3.11.0',
         ],
+        'snapshot': [
+            'brotli',
+        ],
     },
     test_suite="numerals",
     entry_points="""\
     [paste.app_factory]
     main = numerals:main
+    [console_scripts]
+    numerals-geojson = numerals.scripts.render_geojson:main
+    numerals-snapshot = numerals.scripts.snapshot:main
 """)
@@ -13,9 +13,15 @@ import pytest
         ('get_html', '/valuesets/10-numerals-rapa1244-1'),
         ('get_html', '/valuesets/1-numerals-chan1310-1'),
         ('get_html', '/values?contribution=numerals&sSearch_0=Base'),
+        ('get_dt', '/values?parameter=1&sSearch_3=rm1&sSearch_4=v1'),
+        ('get_dt', '/parameters?sSearch_0=1-10'),
+        ('get_dt', '/values?language=numerals-chan1310-1&sSearch_0=-5'),
+        ('get_dt', '/values?sSearch_0=1-5&iSortingCols=1&iSortCol_0=0&sSortDir_0=desc'),
         ('get_html', '/sources'),
+        ('get_html', '/download'),
         ('get_html', '/parameters/-1.geojson?domainelement=decimal&layer=decimal'),
         ('get_html', '/languages'),
+        ('get_dt', '/languages?sSearch_2=1240&sSearch_3=xa'),
         ('get_html', '/languages/numerals-chan1310-1'),
         ('get_html', '/languages/numerals-aton1241-1'),
         ('get_html', '/languages/numerals-abai1240-1'),
@@ -25,3 +31,162 @@ import pytest
     ])
 def test_pages(app, method, path):
     getattr(app, method)(path)
+
+
+def test_values_number_range(app):
+    res = app.get_dt('/values?sSearch_0=1-5').json
+    # Values are not repeated per matching parameter:
+    assert 0 < res['iTotalDisplayRecords'] < res['iTotalRecords']
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        'language=numerals-chan1310-1&iSortingCols=1&iSortCol_0=0&sSortDir_0=asc',
+        # Sorting by a column with NULLs:
+        'language=numerals-chan1310-1&iSortingCols=1&iSortCol_0=3&sSortDir_0=desc',
+        'parameter=1&iSortingCols=3&iSortCol_0=2&iSortCol_1=3&iSortCol_2=0',
+        'parameter=1&iSortingCols=1&iSortCol_0=5&sSortDir_0=asc',
+        'iSortingCols=1&iSortCol_0=0&sSortDir_0=desc&sSearch_0=1-5',
+        'contribution=numerals',
+    ])
+def test_keyset_pagination(app, query):
+    def pages():
+        res, start, total = [], 0, 1
+        while start < total:
+            page = app.get_dt('/values?{0}&iDisplayStart={1}&iDisplayLength=5'.format(
+                query, start)).json
+            total = page['iTotalDisplayRecords']
+            res.append(page['aaData'])
+            start += 5
+        return res
+
+    expected = pages()
+    assert len(expected) > 1
+    app.app.registry.settings['numerals.keyset_pagination'] = 'true'
+    # Pages are selected by OFFSET first, then by the sort keys of the preceding page:
+    assert pages() == expected
+    assert pages() == expected
+
+
+def test_tree_query_count(app):
+    from sqlalchemy import event
+    from clld.db.meta import DBSession
+
+    counts = []
+
+    def count(*args, **kw):
+        counts[-1] += 1
+
+    engine = DBSession.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for pids in ['10', '1,2,10', '1,2,3,4,5,10']:
+            counts.append(0)
+            app.get_html('/phylogenies/globaltree?parameters=' + pids)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert len(set(counts[1:])) == 1, counts
+
+
+def test_prerendered_geojson(app, tmp_path):
+    import gzip
+    from pyramid.request import Request
+    from numerals.prerendered import GeoJsonFiles, render_geojson
+
+    assert render_geojson(app.app, tmp_path)
+    files = GeoJsonFiles(tmp_path)
+    url = '/parameters/-1.geojson?domainelement=decimal&layer=decimal'
+    req = Request.blank(url, headers={'Accept-Encoding': 'gzip'})
+    res = files.response(req, files.path(req))
+    assert gzip.decompress(res.body) == app.get(url).body
+    req = Request.blank(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': res.etag})
+    assert req.get_response(files.response(req, files.path(req))).status_int == 304
+    assert files.path(Request.blank('/parameters/-1.geojson?layer=x')) is None
+
+
+def test_page_cache(app):
+    import gzip
+    from pyramid.request import Request
+    from pyramid.response import Response
+    from numerals.cache import LRUCache
+    from numerals.httpcache import PageCache
+
+    pages = PageCache(LRUCache())
+    handler = lambda req: req.get_response(app.app)  # noqa: E731
+    res = pages(Request.blank('/parameters/1'), handler)
+    assert res.etag and len(pages.cache) == 1
+    assert pages(Request.blank('/parameters/1'), handler).body == res.body
+    req = Request.blank('/parameters/1', headers={'If-None-Match': res.etag})
+    assert pages(req, handler).status_int == 304
+    # Pages contain absolute URLs:
+    other = pages(Request.blank('/parameters/1', base_url='https://example.org'), handler)
+    assert other.etag != res.etag and 'https://example.org/' in other.text
+
+    # Encoded responses, e.g. pre-rendered GeoJSON, are not stored:
+    res = pages(
+        Request.blank('/parameters/1.geojson', headers={'Accept-Encoding': 'gzip'}),
+        lambda req: Response(
+            body=gzip.compress(b'{}'), content_encoding='gzip', vary=('Accept-Encoding',)))
+    assert res.content_encoding == 'gzip' and len(pages.cache) == 2
+    res = pages(Request.blank('/parameters/1.geojson'), handler)
+    assert res.content_encoding is None and res.vary == ('Accept',)
+
+
+def test_snapshot(app, tmp_path):
+    import re
+    import gzip
+    import json
+    from numerals.prerendered import geojson_path
+    from numerals.snapshot import render_paths, snapshot_file, copy_static, layer_path
+
+    base_url = 'https://numerals.example.org'
+    paths = [
+        '/parameters/1',
+        '/parameters/-1',
+        '/languages',
+        '/languages.geojson?layer=id',
+        (geojson_path('1'), layer_path('1')),
+        (geojson_path('-1', 'decimal'), layer_path('-1', 'decimal')),
+        (geojson_path('-1', 'quinary'), layer_path('-1', 'quinary')),
+    ]
+    assert render_paths(app.app, paths, tmp_path, base_url=base_url) == len(paths)
+    page = snapshot_file(tmp_path, '/parameters/1')
+    assert page == tmp_path / 'parameters' / '1' / 'index.html'
+    assert 'https://numerals.example.org/static/numeralbank.png' in page.read_text('utf8')
+    assert 'http://localhost' not in page.read_text('utf8')
+    assert gzip.decompress((tmp_path / 'parameters' / '1' / 'index.html.gz').read_bytes()) \
+        == page.read_bytes()
+
+    # The maps in the mirror find the GeoJSON of their layers in files:
+    for path in ['/parameters/1', '/parameters/-1', '/languages']:
+        layers = json.loads(re.search(
+            r'CLLD\.map\("map", (\{[^}]+\})', snapshot_file(tmp_path, path).read_text('utf8'),
+        ).group(1))
+        assert layers
+        for layer, url in layers.items():
+            assert url.startswith(base_url) and '?' not in url
+            geojson = json.loads(snapshot_file(tmp_path, url[len(base_url):]).read_text('utf8'))
+            assert geojson['properties']['layer'] == layer
+    # The app itself serves the layers by query:
+    assert '/parameters/-1.geojson?domainelement=decimal' in app.get('/parameters/-1').text
+
+    copy_static(app.app.registry, tmp_path)
+    assert (tmp_path / 'static' / 'numeralbank.png').exists()
+    assert (tmp_path / 'clld-static' / 'project.js').exists()
+
+
+def test_stream_geojson(app):
+    def features(res):
+        assert res['type'] == 'FeatureCollection'
+        return sorted((f['id'], f['geometry']['coordinates']) for f in res['features'])
+
+    # The map requests the GeoJSON through XHR - which also bypasses the page cache:
+    orm = app.get('/languages.geojson', xhr=True).json
+    app.app.registry.settings['numerals.stream_geojson'] = 'true'
+    res = app.get('/languages.geojson', xhr=True)
+    assert res.content_type == 'application/json'
+    assert features(res.json) == features(orm) and orm['features']
+    # The streamed features embed only the language fields used by the map:
+    assert set(res.json['features'][0]['properties']['language']) == \
+        {'pk', 'id', 'name', 'latitude', 'longitude'}
@@ -1,4 +1,155 @@
+import pytest
+
+
 def test_init():
     from numerals.scripts import initializedb
 
     assert initializedb
+
+
+def test_iter_forms_parallel(tmp_path):
+    from pycldf import Wordlist
+    from numerals.scripts.loader import iter_forms, iter_forms_parallel
+
+    ds = Wordlist.in_dir(tmp_path)
+    ds.add_columns(
+        'FormTable', 'http://cldf.clld.org/v1.0/terms.rdf#value', {'name': 'Loan', 'datatype': 'boolean'})
+    ds.write(FormTable=[
+        dict(
+            ID='f{0}'.format(i),
+            Language_ID='numerals-abcd1234-1',
+            Parameter_ID='p{0}'.format(i % 3),
+            Form='form{0}'.format(i),
+            Value='form{0}'.format(i),
+            Loan=bool(i % 2),
+            Source=['src'] if i % 2 else [],
+        ) for i in range(20)])
+    param_map = {'p1': '1', 'p2': '2'}
+
+    forms = list(iter_forms(ds, param_map))
+    assert len(forms) == 13
+    assert forms[0].valueset_id == '1-numerals-abcd1234-1'
+    assert list(iter_forms_parallel(ds, param_map, processes=2, chunksize=3)) == forms
+
+
+@pytest.mark.parametrize(
+    "names",
+    [
+        {'a'},
+        {'a', 'b'},
+        {'a', 'c', 'x'},
+        {'c', 'd', 'e'},
+        {'a', 'b', 'c', 'd', 'e', 'f'},
+        # Internal nodes, e.g. languages of which dialects are selected, too:
+        {'lang', 'd1', 'g'},
+        {'lang', 'g'},
+        {'lang'},
+        {'lang', 'd1'},
+        {'ab', 'a'},
+        {'ab', 'a', 'c'},
+        {'abc', 'ab', 'a', 'f'},
+    ])
+def test_TreeSlicer(names):
+    import ete3
+    from numerals.scripts.global_tree import TreeSlicer
+
+    newick = '((((a,b)ab,c)abc,(d,(e))),((f)),((d1,d2)lang,g));'
+    t = ete3.Tree(newick, format=1)
+    t.prune(names.intersection(n.name for n in t.traverse()), preserve_branch_length=False)
+    assert TreeSlicer(newick).prune(names) == t.write(format=9)
+
+
+def test_LRUCache(tmp_path):
+    from numerals.cache import LRUCache, SqliteStore
+
+    cache = LRUCache(maxsize=2, store=SqliteStore(tmp_path / 'cache.sqlite'))
+    assert cache.get_or_create('a', lambda: 'x') == 'x'
+    cache.set('b', 'y')
+    cache.set('c', 'z')
+    assert 'a' not in cache and len(cache) == 2
+    assert cache.get('a') == 'x'
+    assert LRUCache(store=SqliteStore(tmp_path / 'cache.sqlite')).get('c') == 'z'
+
+
+def test_PrimeCacheState(tmp_path):
+    from numerals.scripts.incremental import PrimeCacheState
+
+    state = PrimeCacheState(tmp_path / 'state.sqlite', 'v1')
+    state.set('tree', ['global', ['abcd1234']], '(abcd1234);')
+    state.set('tree', ['family', ['abcd1234']], '(abcd1234);')
+    assert state.get('tree', ['global', ['abcd1234']]) is None
+    state.save()
+
+    state = PrimeCacheState(tmp_path / 'state.sqlite', 'v1')
+    assert state.get('tree', ['global', ['abcd1234']]) == '(abcd1234);'
+    state.save()
+    # Only the results used for the last load are kept:
+    assert PrimeCacheState(tmp_path / 'state.sqlite', 'v1').get(
+        'tree', ['family', ['abcd1234']]) is None
+    # Results depend on the Glottolog version:
+    assert PrimeCacheState(tmp_path / 'state.sqlite', 'v2').get(
+        'tree', ['global', ['abcd1234']]) is None
+
+
+def test_normalize_form():
+    from numerals.util import normalize_form
+
+    assert normalize_form(None) is None
+    assert normalize_form('ˈfo,rmː') == 'form'
+    assert normalize_form('e\u0301') == '\xe9'
+
+
+def test_BulkLoader(db):
+    from clld.db.meta import DBSession
+    from clld.db.models import common
+    from numerals import models
+    from numerals.scripts.loader import BulkLoader, FormRow, lexeme
+
+    DBSession.remove()
+    DBSession.configure(bind=db)
+    lang = models.Variety(id='l', name='L')
+    param = models.NumberParameter(id='1', name='1')
+    # Valuesets are unique per language, parameter and contribution:
+    contribs = [common.Contribution(id=id_, name=id_) for id_ in ['orm', 'bulk']]
+    DBSession.add_all([lang, param] + contribs)
+    DBSession.flush()
+
+    def forms(prefix):
+        return [
+            FormRow(
+                id='{0}{1}'.format(prefix, i),
+                name='ˈfo,rm{0}'.format(i),
+                comment=None,
+                is_loan=is_loan,
+                other_form=None,
+                is_problematic=None,
+                language_id='l',
+                parameter_id='1',
+                valueset_id='{0}-1-l'.format(prefix),
+                source=None,
+            ) for i, is_loan in enumerate([None, True, False])]
+
+    vs = common.ValueSet(id='orm-1-l', language=lang, parameter=param, contribution=contribs[0])
+    for row in forms('orm'):
+        DBSession.add(lexeme(row, vs))
+    DBSession.flush()
+    loader = BulkLoader()
+    vs = loader.add_valueset('bulk-1-l', lang, param, contribs[1], None)
+    for row in forms('bulk'):
+        loader.add_lexeme(row, vs)
+    loader.close()
+
+    def rows(prefix):
+        return [
+            (v.id[len(prefix):], v.name, v.valueset.id[len(prefix):], v.is_loan, v.is_problematic,
+             v.normalized_form, v.other_form)
+            for v in DBSession.query(models.NumberLexeme)
+            .filter(models.NumberLexeme.id.startswith(prefix))
+            .order_by(models.NumberLexeme.pk)]
+
+    try:
+        assert rows('orm') == rows('bulk')
+        assert rows('bulk')[0][3:5] == (False, False)
+    finally:
+        DBSession.rollback()
+        DBSession.remove()